@@ -0,0 +1 @@
+# makes lib importable for the tests, which run from src/ like the notebooks: python -m pytest tests
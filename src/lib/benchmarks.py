@@ -0,0 +1,478 @@
+"""
+Offline benchmark suite of the library hot paths on synthetic data.
+
+The generators build data with the layout of the real pipeline (raw LSMS tables, the processed surveys, the OSM
+feature tables, the CNN embeddings as CSV or feature store and GZIP TFRecords with the schema of TfrecordHelper), so
+no survey files, Earth Engine or network access are needed. Every benchmark is set up once per scale (number of
+clusters) and timed over a few repeats. Benchmarks are skipped above their maximum scale (MAX_SCALES), where the data
+would not fit into the memory of a workstation.
+
+The TFRecord benchmarks time process_dataset (ms + nightlights and rgb), process_dataset_batched and
+process_nightlights. The *_legacy variants run the previous per-band crop of process_dataset as baseline, so the
+speedup of cropping the bands together can be measured in one run.
+
+The results are saved as JSON (by default in data/benchmarks/, named by commit and time) with the library versions and
+the git commit, compare_results shows the change between two saved runs. The peak memory is the one of the process,
+it only grows over the suite; run a single benchmark for its own peak.
+
+Run from src/:
+    python -m lib.benchmarks --scales 1000 10000
+    python -m lib.benchmarks --benchmarks get_data run_ridge --out ../data/benchmarks/current.json
+    python -m lib.benchmarks --compare ../data/benchmarks/base.json ../data/benchmarks/current.json
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from lib import estimator_util
+from lib.feature_store import cnn_columns, write_feature_store
+from lib.indicators import CPI, IndicatorStore, frame_source, get_store, set_store
+from lib.lsms import LSMS
+from lib.osm import BUILDING_FILTERS, AREA_METRICS, LENGTH_METRICS, POI_TYPES, ROAD_TYPES
+from lib.profiling import peak_rss_mb
+
+import numpy as np
+import pandas as pd
+
+RESULTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "data", "benchmarks")
+SCALES = (1_000, 10_000, 100_000, 1_000_000)
+# surveys of the synthetic data, with the share of the clusters of the real data
+SURVEYS = {("ETH", 2013): 475, ("ETH", 2015): 525, ("ETH", 2018): 516, ("MW", 2016): 781, ("MW", 2019): 710,
+           ("NG", 2012): 503, ("NG", 2015): 669, ("NG", 2018): 645, ("TZA", 2012): 1611, ("TZA", 2014): 419}
+N_FEATURES = 512
+HOUSEHOLDS = 8
+TFRECORD_BANDS = ["RED", "GREEN", "BLUE", "SWIR1", "SWIR2", "TEMP1", "NIR", "NIGHTLIGHTS"]
+# clusters above which a benchmark is skipped
+MAX_SCALES = {
+    "process_survey": 1_000_000,
+    "get_data": 1_000_000,
+    "get_data_csv": 10_000,
+    "get_data_table": 1_000_000,
+    "get_features": 100_000,
+    "get_recent_features": 100_000,
+    "get_features_allyears": 100_000,
+    "run_ridge": 100_000,
+    "run_ridge_out": 100_000,
+    "process_dataset": 1_000,
+    "process_dataset_batched": 1_000,
+    "process_dataset_legacy": 1_000,
+    "process_dataset_rgb": 1_000,
+    "process_dataset_rgb_legacy": 1_000,
+    "process_nightlights": 1_000,
+}
+
+
+def synthetic_survey(n_clusters: int, households: int = HOUSEHOLDS, seed: int = 0):
+    """
+    Raw consumption and geovariable tables of one survey, for LSMS.process_survey.
+
+    Args:
+    - n_clusters (int): Number of clusters
+    - households (int): Households per cluster
+    - seed (int): Random seed
+
+    Return:
+    - pd.Dataframe: consumption (hhid, cons, hhsize, rural)
+    - pd.Dataframe: geovariables (hhid, lat, lon), shuffled
+    """
+    rng = np.random.default_rng(seed)
+    n = n_clusters * households
+    cluster = np.repeat(np.arange(n_clusters), households)
+    lat, lon = rng.uniform(-15, 15, n_clusters).round(5), rng.uniform(0, 45, n_clusters).round(5)
+    hhid = rng.permutation(n) + 100_000
+    df_cons = pd.DataFrame({
+        "hhid": hhid,
+        "cons": rng.lognormal(10, 1, n),
+        "hhsize": rng.integers(1, 10, n),
+        "rural": np.where(rng.random(n_clusters) < 0.7, "RURAL", "URBAN")[cluster],
+    })
+    df_hh = pd.DataFrame({"hhid": hhid, "lat": lat[cluster], "lon": lon[cluster]}).sample(frac=1, random_state=seed)
+    return df_cons, df_hh.reset_index(drop=True)
+
+
+def synthetic_lsms(n_clusters: int, seed: int = 0) -> pd.DataFrame:
+    """
+    Processed surveys (the layout of _all_{nominal,real}.csv), the clusters split over SURVEYS.
+    """
+    rng = np.random.default_rng(seed)
+    shares = np.array(list(SURVEYS.values()), dtype=float)
+    counts = np.floor(shares / shares.sum() * n_clusters).astype(int)
+    counts[0] += n_clusters - counts.sum()
+    surveys = list(SURVEYS)
+    survey = np.repeat(np.arange(len(surveys)), counts)
+    within = np.arange(n_clusters) - np.repeat(np.cumsum(counts) - counts, counts)
+    country = np.array([c for c, _ in surveys], dtype=object)[survey]
+    year = np.array([y for _, y in surveys])[survey]
+    return pd.DataFrame({
+        "country": country,
+        "year": year,
+        "lat": rng.uniform(-15, 15, n_clusters).round(5),
+        "lon": rng.uniform(0, 45, n_clusters).round(5),
+        "cons_pc": rng.lognormal(1, 0.8, n_clusters),
+        "id": pd.Series(country).str.cat([year.astype(str), within.astype(str)], sep="_").to_numpy(),
+        "rural": np.where(rng.random(n_clusters) < 0.7, "rural", "urban"),
+    })
+
+
+def synthetic_osm(lsms: pd.DataFrame, seed: int = 0) -> dict:
+    """
+    OSM feature tables of the clusters with the columns of _all_buildings, _all_pois and _all_road.
+
+    Return:
+    - dict: "buildings", "pois" and "road" frames
+    """
+    rng = np.random.default_rng(seed)
+    n = len(lsms)
+    buildings = {f"{key}_{metric}": rng.poisson(5, n) * 1.0 for key in BUILDING_FILTERS for metric in AREA_METRICS}
+    pois = {name: rng.poisson(0.5, n) for name in POI_TYPES}
+    road = {f"total_{metric}": rng.exponential(100, n) for metric in LENGTH_METRICS}
+    road.update({f"{metric}_{name}": rng.exponential(10, n) for metric in LENGTH_METRICS for name in ROAD_TYPES})
+    return {
+        "buildings": pd.DataFrame({"id": lsms["id"], **buildings}),
+        "pois": pd.DataFrame({**pois, "id": lsms["id"]}),  # id is the last column of _all_pois
+        "road": pd.DataFrame({"id": lsms["id"], **road}),
+    }
+
+
+def synthetic_cnn(lsms: pd.DataFrame, n_features: int = N_FEATURES, seed: int = 0):
+    """
+    CNN embeddings of the clusters.
+
+    Return:
+    - pd.Dataframe: index (year, lat, lon, nightlight)
+    - np.array: float32 features with shape (n, n_features)
+    """
+    rng = np.random.default_rng(seed)
+    index = pd.DataFrame({"year": lsms["year"], "lat": lsms["lat"], "lon": lsms["lon"],
+                          "nightlight": rng.exponential(1, len(lsms))})
+    return index, rng.standard_normal((len(lsms), n_features), dtype=np.float32)
+
+
+def write_inputs(path: str, n_clusters: int, n_features: int = N_FEATURES, cnn_csv: bool = False, seed: int = 0) -> tuple:
+    """
+    Write synthetic inputs of get_data: lsms.csv, the CNN features (feature store, and the CSV if cnn_csv) and
+    osm_features/_all_*.csv.
+
+    Return:
+    - tuple: lsms_path, cnn_path (store), osm_path, cnn_csv_path (None if not written)
+    """
+    lsms = synthetic_lsms(n_clusters, seed)
+    os.makedirs(os.path.join(path, "osm_features"), exist_ok=True)
+    lsms.to_csv(os.path.join(path, "lsms.csv"), index=False)
+    for name, frame in synthetic_osm(lsms, seed).items():
+        frame.to_csv(os.path.join(path, "osm_features", f"_all_{name}.csv"), index=False)
+    index, features = synthetic_cnn(lsms, n_features, seed)
+    write_feature_store(os.path.join(path, "cnn"), features, index)
+    csv_path = None
+    if cnn_csv:
+        csv_path = os.path.join(path, "cnn.csv")
+        index.assign(features=features.round(5).tolist()).to_csv(csv_path, index=False)
+    return os.path.join(path, "lsms.csv"), os.path.join(path, "cnn"), path + os.sep, csv_path
+
+
+def write_tfrecords(path: str, n_records: int, seed: int = 0) -> None:
+    """
+    Write a GZIP TFRecord file with the schema of TfrecordHelper (the bands as 255*255 floats, lat, lon, year). The
+    bands are constant and drawn from a few prebuilt values, so writing is fast and the file small while the parsing
+    cost is the same.
+    """
+    import tensorflow as tf
+
+    rng = np.random.default_rng(seed)
+    bands = [tf.train.Feature(float_list=tf.train.FloatList(value=np.full(255**2, value, np.float32)))
+             for value in np.linspace(0.05, 1, 16)]
+    with tf.io.TFRecordWriter(path, options="GZIP") as writer:
+        for _ in range(n_records):
+            feature = {band: bands[i] for band, i in zip(TFRECORD_BANDS, rng.integers(0, len(bands), len(TFRECORD_BANDS)))}
+            for key, value in (("lat", rng.uniform(-15, 15)), ("lon", rng.uniform(0, 45)), ("year", 2015.0)):
+                feature[key] = tf.train.Feature(float_list=tf.train.FloatList(value=[value]))
+            writer.write(tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString())
+
+
+def _setup_process_survey(scale: int, workdir: str):
+    df_cons, df_hh = synthetic_survey(scale)
+
+    def run() -> int:
+        survey = LSMS("NG", 2015, ppp=1.0)
+        survey.df_cons, survey.df_hh = df_cons, df_hh
+        survey.process_survey(cons_key="cons", hhsize_key="hhsize", lat_key="lat", lon_key="lon",
+                              rural_tag="RURAL", urban_tag="URBAN")
+        return len(df_cons)
+    return run
+
+
+def _setup_get_data(scale: int, workdir: str):
+    lsms_path, cnn_path, osm_path, _ = write_inputs(workdir, scale)
+    return lambda: len(estimator_util.get_data(lsms_path, cnn_path, osm_path)[0])
+
+
+def _setup_get_data_csv(scale: int, workdir: str):
+    lsms_path, _, osm_path, csv_path = write_inputs(workdir, scale, cnn_csv=True)
+    return lambda: len(estimator_util.get_data(lsms_path, csv_path, osm_path)[0])
+
+
+def _setup_get_data_table(scale: int, workdir: str):
+    lsms_path, cnn_path, osm_path, _ = write_inputs(workdir, scale)
+    table_path = os.path.join(workdir, "table")
+    estimator_util.get_data(lsms_path, cnn_path, osm_path, table_path=table_path)
+    return lambda: len(estimator_util.get_data(lsms_path, cnn_path, osm_path, table_path=table_path)[0])
+
+
+def _feature_frame(scale: int):
+    lsms = synthetic_lsms(scale)
+    osm = synthetic_osm(lsms)
+    index, features = synthetic_cnn(lsms)
+    complete = pd.concat([lsms, osm["buildings"].drop(columns="id"), osm["road"].drop(columns="id"),
+                          osm["pois"].drop(columns="id"),
+                          pd.DataFrame(features, columns=cnn_columns(features.shape[1]))], axis=1)
+    osm_cols = [col for name in ("buildings", "road", "pois") for col in osm[name].columns if col != "id"]
+    return complete, osm_cols
+
+
+def _setup_get_features(scale: int, workdir: str):
+    complete, osm_cols = _feature_frame(scale)
+    # every country must have every year, as in the notebooks
+    return lambda: len(estimator_util.get_features(complete, ["ETH", "NG"], [2015, 2018], osm_cols)[1])
+
+
+def _setup_get_recent_features(scale: int, workdir: str):
+    complete, osm_cols = _feature_frame(scale)
+    countries = sorted({country for country, _ in SURVEYS})
+    return lambda: len(estimator_util.get_recent_features(complete, countries, osm_cols)[1])
+
+
+def _setup_get_features_allyears(scale: int, workdir: str):
+    complete, osm_cols = _feature_frame(scale)
+    countries = sorted({country for country, _ in SURVEYS})
+    # synthetic CPI instead of the World Bank
+    cpi = pd.DataFrame([(CPI, country, year, 100 * 1.05 ** (year - 2010)) for country in countries for year in range(2005, 2025)],
+                       columns=["indicator", "country", "year", "value"])
+    store = IndicatorStore(os.path.join(workdir, "indicators.csv"), frame_source(cpi))
+
+    def run() -> int:
+        previous = get_store()
+        set_store(store)
+        try:
+            return len(estimator_util.get_features_allyears(complete, countries, osm_cols)[1])
+        finally:
+            set_store(previous)
+    return run
+
+
+def _ridge_data(scale: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    n_cols = N_FEATURES + len(BUILDING_FILTERS) * len(AREA_METRICS) + len(POI_TYPES) + 3 * (len(ROAD_TYPES) + 1)
+    X = rng.standard_normal((scale, n_cols))
+    y = X[:, :10].sum(axis=1) + rng.standard_normal(scale)
+    return X, y
+
+
+def _setup_run_ridge(scale: int, workdir: str):
+    X, y = _ridge_data(scale)
+
+    def run() -> int:
+        estimator_util.run_ridge(X, y)
+        return len(X)
+    return run
+
+
+def _setup_run_ridge_out(scale: int, workdir: str):
+    X, y = _ridge_data(scale)
+    X_out, y_out = _ridge_data(max(scale // 10, 10), seed=1)
+
+    def run() -> int:
+        estimator_util.run_ridge_out(X, y, X_out, y_out)
+        return len(X)
+    return run
+
+
+def _legacy_process_dataset(helper) -> None:
+    """
+    process_dataset before the bands were cropped together: every band is reshaped and cropped on its own and the
+    bands are stacked at the end. Kept as the baseline of the TFRecord benchmarks.
+    """
+    import tensorflow as tf
+
+    bands = helper.bands()
+    keys_to_features = helper.feature_spec()
+
+    def process_tfrecord(record):
+        ex = tf.io.parse_single_example(record, features=keys_to_features)
+        loc = tf.stack([ex[helper.keyword_lat], ex[helper.keyword_lon]])
+        year = tf.cast(ex.get("year", -1), tf.int32)
+        img = tf.stack([tf.reshape(ex[band], [255, 255])[15:-16, 15:-16] for band in bands], axis=2)
+        return {"images": img, "locs": loc, "years": year}
+
+    helper.dataset = helper.raw_dataset.map(process_tfrecord, num_parallel_calls=3)
+
+
+def _setup_process_dataset(scale: int, workdir: str, mode: str = "process_dataset", ls_bands: str = "ms"):
+    from lib.tfrecordhelper import TfrecordHelper, element_rows
+
+    path = os.path.join(workdir, "records.tfrecord.gz")
+    write_tfrecords(path, scale)
+
+    def run() -> int:
+        helper = TfrecordHelper(path, ls_bands=ls_bands, nl_band="viirs" if ls_bands == "ms" else None)
+        if mode == "legacy":
+            _legacy_process_dataset(helper)
+        else:
+            getattr(helper, mode)()
+        return sum(element_rows(element) for element in helper.dataset)
+    return run
+
+
+BENCHMARKS = {
+    "process_survey": _setup_process_survey,
+    "get_data": _setup_get_data,
+    "get_data_csv": _setup_get_data_csv,
+    "get_data_table": _setup_get_data_table,
+    "get_features": _setup_get_features,
+    "get_recent_features": _setup_get_recent_features,
+    "get_features_allyears": _setup_get_features_allyears,
+    "run_ridge": _setup_run_ridge,
+    "run_ridge_out": _setup_run_ridge_out,
+    "process_dataset": _setup_process_dataset,
+    "process_dataset_batched": lambda scale, workdir: _setup_process_dataset(scale, workdir, "process_dataset_batched"),
+    "process_dataset_legacy": lambda scale, workdir: _setup_process_dataset(scale, workdir, "legacy"),
+    "process_dataset_rgb": lambda scale, workdir: _setup_process_dataset(scale, workdir, ls_bands="rgb"),
+    "process_dataset_rgb_legacy": lambda scale, workdir: _setup_process_dataset(scale, workdir, "legacy", "rgb"),
+    "process_nightlights": lambda scale, workdir: _setup_process_dataset(scale, workdir, "process_nightlights"),
+}
+
+
+def run_benchmark(name: str, scale: int, repeats: int = 3) -> dict:
+    """
+    Set up one benchmark at one scale in a temporary directory and time it.
+
+    Args:
+    - name (str): Key of BENCHMARKS
+    - scale (int): Number of clusters (TFRecord benchmarks: records)
+    - repeats (int): Number of timed runs
+
+    Return:
+    - dict: benchmark, scale, rows, setup time, best and mean wall time, rows per second and peak memory
+    """
+    with tempfile.TemporaryDirectory() as workdir:
+        start = time.perf_counter()
+        run = BENCHMARKS[name](scale, workdir)
+        setup_s = time.perf_counter() - start
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            rows = run()
+            times.append(time.perf_counter() - start)
+    return {
+        "benchmark": name,
+        "scale": scale,
+        "rows": int(rows),
+        "setup_s": setup_s,
+        "best_s": min(times),
+        "mean_s": float(np.mean(times)),
+        "rows_per_s": rows / min(times),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def environment() -> dict:
+    """
+    Versions and machine of the run, stored with the results.
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def run_suite(scales: list = SCALES, benchmarks: list = None, repeats: int = 3, out_path: str = None,
+              max_scales: dict = None) -> pd.DataFrame:
+    """
+    Run the benchmarks at all scales up to their maximum scale.
+
+    Args:
+    - scales (list): Numbers of clusters
+    - benchmarks (list): Keys of BENCHMARKS, all if None
+    - repeats (int): Number of timed runs per benchmark and scale
+    - out_path (str): JSON file for the results, not saved if None
+    - max_scales (dict): Overrides of MAX_SCALES
+
+    Return:
+    - pd.Dataframe: one row per benchmark and scale
+    """
+    limits = {**MAX_SCALES, **(max_scales or {})}
+    results = []
+    for name in benchmarks or list(BENCHMARKS):
+        for scale in scales:
+            if scale > limits[name]:
+                continue
+            results.append(run_benchmark(name, scale, repeats))
+            print(f"{name} {scale}: {results[-1]['best_s']:.3f}s", flush=True)
+
+    if out_path is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+        with open(out_path, "w") as f:
+            json.dump({"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "environment": environment(),
+                       "repeats": repeats, "results": results}, f, indent=4)
+    return pd.DataFrame(results)
+
+
+def load_results(path: str) -> pd.DataFrame:
+    """
+    Read the results saved by run_suite.
+    """
+    with open(path, "r") as f:
+        return pd.DataFrame(json.load(f)["results"])
+
+
+def compare_results(base_path: str, path: str) -> pd.DataFrame:
+    """
+    Compare two saved runs by benchmark and scale.
+
+    Return:
+    - pd.Dataframe: best wall time of both runs and the ratio new / base (> 1 is a regression)
+    """
+    columns = ["benchmark", "scale", "best_s", "peak_rss_mb"]
+    table = load_results(base_path)[columns].merge(load_results(path)[columns], on=["benchmark", "scale"],
+                                                   how="outer", suffixes=("_base", "_new"))
+    table["ratio"] = table.best_s_new / table.best_s_base
+    return table
+
+
+def main(argv: list = None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmarks of the library on synthetic data")
+    parser.add_argument("--scales", type=int, nargs="+", default=list(SCALES), help="numbers of clusters")
+    parser.add_argument("--benchmarks", nargs="+", choices=list(BENCHMARKS), help="benchmarks to run, all by default")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--out", help="JSON file for the results, by default in data/benchmarks/")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="compare two saved runs instead")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        print(compare_results(*args.compare).to_string(index=False))
+        return
+    out = args.out
+    if out is None:
+        commit = (environment()["commit"] or "unknown")[:7]
+        out = os.path.join(RESULTS_PATH, f"{commit}_{time.strftime('%Y%m%d-%H%M%S')}.json")
+    print(run_suite(args.scales, args.benchmarks, args.repeats, out).to_string(index=False))
+    print(f"saved to {os.path.normpath(out)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""
+Batched CPU extraction of the CNN features from the TFRecords.
+
+The records are decoded by the batched TfrecordHelper pipeline (tf.data threads, prefetched while the model runs),
+embedded by the trained ResNet-18 without its last layer and appended chunk by chunk to an output directory. Every chunk
+is a float32 .npy matrix with a Parquet index (year, lat, lon, nightlight). The number of records consumed per input
+file is checkpointed after each chunk, so an interrupted run continues where it stopped. finalize() merges the chunks
+into a feature store (see feature_store.py) which get_data reads directly.
+"""
+from __future__ import annotations
+
+import json
+import os
+import sys
+
+# torch and torchvision have to be loaded before tensorflow, the other order crashes on CPU. Importing this module
+# first only helps if tensorflow is not loaded yet (e.g. by lib.tfrecordhelper in an earlier cell)
+if "tensorflow" in sys.modules and "torchvision" not in sys.modules:
+    raise ImportError("lib.cnn_features has to be imported before tensorflow (or lib.tfrecordhelper), otherwise "
+                      "importing torchvision or running the model crashes on CPU. Restart the kernel and import "
+                      "lib.cnn_features first.")
+
+import torch
+import torch.nn as nn
+import torchvision
+
+from lib.feature_store import write_feature_store
+from lib.profiling import profiled
+from lib.tfrecordhelper import TfrecordHelper
+
+import numpy as np
+import pandas as pd
+
+PROGRESS_FILE = "progress.json"
+CHUNK_FEATURES = "chunk_{:05d}.npy"
+CHUNK_INDEX = "chunk_{:05d}.parquet"
+NBANDS = 7
+
+
+def build_model(weights_path: str, n_classes: int = 5) -> nn.Module:
+    """
+    Build the feature extractor of 1_cnn.ipynb: ResNet-18 with a 7 band input layer, the trained weights loaded and the
+    classification layer removed.
+
+    Args:
+    - weights_path (str): Path to the saved state dict
+    - n_classes (int): Number of nightlight classes the model was trained on
+
+    Return:
+    - nn.Module: outputs (batch, 512, 1, 1)
+    """
+    model = torchvision.models.resnet18(weights=None)
+    model.conv1 = nn.Conv2d(NBANDS, 64, kernel_size=(7, 7), stride=(2, 2), padding=(3, 3), dilation=1, bias=False)
+    model.fc = nn.Linear(model.fc.in_features, n_classes)
+    model.load_state_dict(torch.load(weights_path, map_location="cpu"))
+    return nn.Sequential(*list(model.children())[:-1]).eval()
+
+
+class FeatureExtractor:
+
+    def __init__(self, model: nn.Module, means: list, stds: list, rgb_factor: float = 3.0, num_threads: int | None = None) -> None:
+        """
+        Embeds batches of images.
+
+        Args:
+        - model (nn.Module): Feature extractor, see build_model
+        - means (list): Means of the 7 landsat bands used for training
+        - stds (list): Standard deviations of the 7 landsat bands used for training
+        - rgb_factor (float): Factor for the RGB bands, the training brightened them by 3
+        - num_threads (int): Number of torch threads, torch default if None
+        """
+        self.model = model
+        self.means = np.asarray(means, dtype=np.float32)
+        self.stds = np.asarray(stds, dtype=np.float32)
+        self.scale = np.ones(NBANDS, dtype=np.float32)
+        self.scale[:3] = rgb_factor
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+
+    @profiled(rows=len)
+    def embed(self, images: np.ndarray) -> np.ndarray:
+        """
+        Args:
+        - images (np.array): (batch, 224, 224, bands), the first 7 bands are used
+
+        Return:
+        - np.array: float32 embeddings (batch, 512)
+        """
+        x = (images[..., :NBANDS] * self.scale - self.means) / self.stds
+        x = torch.from_numpy(np.ascontiguousarray(x.transpose(0, 3, 1, 2), dtype=np.float32))
+        with torch.no_grad():
+            out = self.model(x)
+        return out.reshape(len(images), -1).numpy()
+
+
+def broken_mask(images: np.ndarray) -> np.ndarray:
+    """
+    Records without nightlights or with an empty landsat band, as removed by load_dataset in 1_cnn.ipynb.
+
+    Args:
+    - images (np.array): (batch, 224, 224, 8), nightlights last
+
+    Return:
+    - np.array: bool mask
+    """
+    no_lights = images[..., NBANDS].mean(axis=(1, 2)) == 0
+    empty_band = ~np.all(np.any(images[..., :NBANDS], axis=(1, 2)), axis=1)
+    return no_lights | empty_band
+
+
+def _read_progress(out_path: str) -> dict:
+    path = os.path.join(out_path, PROGRESS_FILE)
+    if not os.path.isfile(path):
+        return {"files": {}, "chunks": 0}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_progress(out_path: str, progress: dict) -> None:
+    tmp = os.path.join(out_path, PROGRESS_FILE + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(progress, f, indent=4)
+    os.replace(tmp, os.path.join(out_path, PROGRESS_FILE))
+
+
+@profiled()
+def extract_features(paths: list, extractor: FeatureExtractor, out_path: str, batch_size: int = 64,
+                     chunk_size: int = 1024, drop_broken: bool = True) -> None:
+    """
+    Embed all records of the TFRecord files and append them to out_path. Can be called again after an interruption,
+    records which are already checkpointed are skipped without decoding.
+
+    Args:
+    - paths (list): TFRecord files (GZIP)
+    - extractor (FeatureExtractor): Model and preprocessing
+    - out_path (str): Output directory
+    - batch_size (int): Number of images per inference batch
+    - chunk_size (int): Number of records per written chunk and checkpoint
+    - drop_broken (bool): Skip records without nightlights or with an empty band
+    """
+    os.makedirs(out_path, exist_ok=True)
+    progress = _read_progress(out_path)
+
+    for path in paths:
+        name = os.path.basename(path)
+        done = progress["files"].get(name, {"records": 0, "complete": False})
+        if done["complete"]:
+            continue
+
+        helper = TfrecordHelper(path, ls_bands="ms", nl_band="viirs")
+        helper.raw_dataset = helper.raw_dataset.skip(done["records"])
+        helper.process_dataset_batched(batch_size=batch_size, interleave=False)
+
+        features, rows, consumed = [], [], 0
+        for batch in helper.iterate():
+            images = batch["images"].numpy()
+            locs = batch["locs"].numpy()
+            years = batch["years"].numpy()
+            consumed += len(images)
+
+            keep = ~broken_mask(images) if drop_broken else np.ones(len(images), dtype=bool)
+            if keep.any():
+                features.append(extractor.embed(images[keep]))
+                rows.append(pd.DataFrame({
+                    "year": years[keep],
+                    "lat": locs[keep, 0],
+                    "lon": locs[keep, 1],
+                    "nightlight": images[keep][..., NBANDS].mean(axis=(1, 2)),
+                }))
+
+            if consumed >= chunk_size:
+                done["records"] += consumed
+                _write_chunk(out_path, progress, name, done, features, rows)
+                features, rows, consumed = [], [], 0
+
+        done["records"] += consumed
+        done["complete"] = True
+        _write_chunk(out_path, progress, name, done, features, rows)
+
+
+def _write_chunk(out_path: str, progress: dict, name: str, done: dict, features: list, rows: list) -> None:
+    """
+    Write the chunk first and then the checkpoint, so a crash in between only repeats the chunk.
+    """
+    if features:
+        chunk = progress["chunks"]
+        np.save(os.path.join(out_path, CHUNK_FEATURES.format(chunk)), np.concatenate(features).astype(np.float32))
+        pd.concat(rows, ignore_index=True).to_parquet(os.path.join(out_path, CHUNK_INDEX.format(chunk)), index=False)
+        progress["chunks"] = chunk + 1
+    progress["files"][name] = done
+    _write_progress(out_path, progress)
+
+
+def finalize(out_path: str, store_path: str) -> None:
+    """
+    Merge the chunks of extract_features into a feature store.
+
+    Args:
+    - out_path (str): Directory written by extract_features
+    - store_path (str): Directory of the feature store
+    """
+    chunks = _read_progress(out_path)["chunks"]
+    features = [np.load(os.path.join(out_path, CHUNK_FEATURES.format(i)), mmap_mode="r") for i in range(chunks)]
+    index = [pd.read_parquet(os.path.join(out_path, CHUNK_INDEX.format(i))) for i in range(chunks)]
+    write_feature_store(store_path, np.concatenate(features), pd.concat(index, ignore_index=True))
+
+
+def load_chunks(out_path: str):
+    """
+    Memory-map the chunks written so far, e.g. to inspect a running extraction.
+
+    Return:
+    - pd.Dataframe: index
+    - list: memory-mapped feature chunks in the order of the index
+    """
+    chunks = _read_progress(out_path)["chunks"]
+    features = [np.load(os.path.join(out_path, CHUNK_FEATURES.format(i)), mmap_mode="r") for i in range(chunks)]
+    index = pd.concat([pd.read_parquet(os.path.join(out_path, CHUNK_INDEX.format(i))) for i in range(chunks)], ignore_index=True)
+    return index, features
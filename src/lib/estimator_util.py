@@ -1,9 +1,8 @@
 """
 Functions of estimation notebooks.
 """
-from scipy.stats import pearsonr
-from sklearn.linear_model import Ridge
-from sklearn.model_selection import KFold
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from sklearn.preprocessing import StandardScaler
 
 import ast
@@ -12,35 +11,75 @@ import numpy as np
 import pandas as pd
 import seaborn as sns
 import string
-import world_bank_data as wb
 
+from lib.feature_store import CNN_PREFIX, is_feature_store, load_feature_frame
+from lib.indicators import CPI, get_store
+from lib.partitions import is_partitioned, read_combined
+from lib.profiling import profiled, set_rows, span
+from lib.ridge import KFoldRidge
+from lib.spatial_index import match_join
+from lib.training_table import (input_fingerprint, is_training_table, load_training_table, table_fingerprint,
+                                write_training_table)
 
-def get_data(lsms_path: str, cnn_path: str, osm_path: str):
+
+@profiled(rows=lambda result: len(result[0]))
+def get_data(lsms_path: str, cnn_path: str, osm_path: str, countries: list = None, years: list = None, table_path: str = None,
+             rebuild: bool = False):
     """
-    Function to load data and merge it
+    Function to load data and merge it. With table_path the merged data is materialized once (see training_table.py)
+    and later calls only memory-map it. The table is rebuilt when one of the inputs changed since it was built.
 
     Args:
-    - lsms_path: Path to lsms file
-    - cnn_path: Path to cnn feature file
-    - osm_path: Base path to OSM files
+    - lsms_path: Path to lsms file, either the CSV or a partitioned dataset (see partitions.py)
+    - cnn_path: Path to cnn feature file, either the CSV or a feature store directory (see feature_store.py)
+    - osm_path: Base path to OSM files, the partitioned datasets osm_features/_all_{buildings,pois,road} are used if they exist
+    - countries (list): Only load these countries, all if None
+    - years (list): Only load these survey years, all if None
+    - table_path (str): Directory of the training table, loaded if it exists otherwise built from the other paths.
+      The table has the CNN features as cnn_* columns and the integer cluster key of the coordinates.
+    - rebuild (bool): Rebuild the table even if the inputs did not change
 
     Return:
     - pd.Dataframe: features of CNN
     - list: features of OSM
     """
-    lsms = pd.read_csv(lsms_path)
-    cnn = pd.read_csv(cnn_path, converters={'features': ast.literal_eval})
+    if table_path is not None:
+        fingerprint = input_fingerprint(_input_paths(lsms_path, cnn_path, osm_path))
+        if rebuild or not is_training_table(table_path) or table_fingerprint(table_path) != fingerprint:
+            complete, all_cols = get_data(lsms_path, cnn_path, osm_path)
+            with span("get_data.write_table", rows=len(complete)):
+                write_training_table(table_path, complete, all_cols, fingerprint)
+        with span("get_data.load_table") as record:
+            complete, all_cols = load_training_table(table_path, countries, years)
+            record.rows = len(complete)
+        return complete, all_cols
+
+    with span("get_data.lsms") as record:
+        lsms = read_combined(lsms_path, countries, years)
+        record.rows = len(lsms)
+    with span("get_data.cnn") as record:
+        if is_feature_store(cnn_path):
+            cnn = load_feature_frame(cnn_path)
+        else:
+            cnn = pd.read_csv(cnn_path, converters={'features': ast.literal_eval})
+        record.rows = len(cnn)
 
     lsms[lsms.select_dtypes(np.float64).columns] = lsms.select_dtypes(
         np.float64).astype(np.float32)
     cnn[cnn.select_dtypes(np.float64).columns] = cnn.select_dtypes(
         np.float64).astype(np.float32)
 
-    cnn_lsms = lsms.merge(cnn, on=["lat", "lon", "year"])
+    with span("get_data.merge_cnn") as record:
+        # like the merge on lat, lon and year, clusters without an exactly equal CNN row get the rows within
+        # MATCH_TOLERANCE_M, which are only float rounding apart
+        cnn_lsms = match_join(lsms, cnn, by=["year"])
+        record.rows = len(cnn_lsms)
 
-    build = pd.read_csv(osm_path + "osm_features/_all_buildings.csv")
-    pois = pd.read_csv(osm_path + "osm_features/_all_pois.csv")
-    roads = pd.read_csv(osm_path + "osm_features/_all_road.csv")
+    with span("get_data.osm") as record:
+        build = _read_osm(osm_path, "buildings", countries, years)
+        pois = _read_osm(osm_path, "pois", countries, years)
+        roads = _read_osm(osm_path, "road", countries, years)
+        record.rows = len(build) + len(pois) + len(roads)
 
     build_cols = build.columns[1:]
     pois_cols = pois.columns[:-1]  # id is last column in my case
@@ -48,13 +87,43 @@ def get_data(lsms_path: str, cnn_path: str, osm_path: str):
 
     all_cols = list(build_cols) + list(roads_cols) + list(pois_cols)
 
-    osm = build.merge(pois, on="id")
-    osm = osm.merge(roads, on="id")
-    complete = osm.merge(cnn_lsms, on="id")
+    with span("get_data.merge_osm") as record:
+        osm = build.merge(pois, on="id")
+        osm = osm.merge(roads, on="id")
+        complete = osm.merge(cnn_lsms, on="id")
+        record.rows = len(complete)
 
     return complete, all_cols
 
 
+def _input_paths(lsms_path: str, cnn_path: str, osm_path: str) -> list:
+    # the OSM tables are read from the partitioned datasets or the CSVs, both are watched
+    osm_paths = [osm_path + f"osm_features/_all_{name}{suffix}" for name in ["buildings", "pois", "road"]
+                 for suffix in ["", ".csv"]]
+    return [lsms_path, cnn_path] + osm_paths
+
+
+def _read_osm(osm_path: str, name: str, countries: list = None, years: list = None) -> pd.DataFrame:
+    path = osm_path + f"osm_features/_all_{name}"
+    return read_combined(path if is_partitioned(path) else path + ".csv", countries, years)
+
+
+def get_cnn_features(df: pd.DataFrame) -> np.array:
+    """
+    Return the CNN features of the dataframe as matrix.
+
+    Args:
+    - df (pd.Dataframe): Dataframe with either the "features" column (CSV) or the cnn_* columns (feature store)
+
+    Return:
+    - np.array: features
+    """
+    if "features" in df.columns:
+        return np.array([np.array(x) for x in df["features"].values])
+    cnn_cols = [col for col in df.columns if col.startswith(CNN_PREFIX)]
+    return df[cnn_cols].to_numpy()
+
+
 def run_ridge(X: np.array, y: np.array, alpha: int = 1000, seed=42):
     """
     Run Ridge Regression
@@ -71,18 +140,11 @@ def run_ridge(X: np.array, y: np.array, alpha: int = 1000, seed=42):
     - model
     """
 
-    kf = KFold(n_splits=10, shuffle=True, random_state=seed)
-    r2 = []
-    for train_ind, test_ind in kf.split(X, y):
-        x_train_fold, x_test_fold = X[train_ind], X[test_ind]
-        y_train_fold, y_test_fold = y[train_ind], y[test_ind]
-        model = Ridge(alpha)
-        model.fit(x_train_fold, y_train_fold)
-        y_predict = model.predict(x_test_fold)
-        r2.append(pearsonr(y_test_fold, y_predict)[0]**2)
-
-    y_hest = model.predict(X)
-    return np.mean(r2), y_hest, model
+    with span("run_ridge", rows=len(X)):
+        engine = KFoldRidge(X, y, n_splits=10, seed=seed)
+        model = engine.model(alpha)
+        y_hest = model.predict(X)
+        return engine.score(alpha), y_hest, model
 
 
 def run_ridge_out(X: np.array, y: np.array, X_out: np.array, y_out: np.array, alpha: int = 1000):
@@ -101,19 +163,37 @@ def run_ridge_out(X: np.array, y: np.array, X_out: np.array, y_out: np.array, al
     - predicated y
     - model
     """
-    kf = KFold(n_splits=10, shuffle=True, random_state=1)
-    r2 = []
-    for train_ind, test_ind in kf.split(X, y):
-        x_train_fold, x_test_fold = X[train_ind], X[test_ind]
-        y_train_fold, y_test_fold = y[train_ind], y[test_ind]
+    with span("run_ridge_out", rows=len(X)):
+        engine = KFoldRidge(X, y, n_splits=10, seed=1)
+        model = engine.model(alpha)
+        y_hest = model.predict(X_out)
+        return engine.score_out(X_out, y_out, alpha), y_hest, model
+
+
+def run_ridge_path(X: np.array, y: np.array, alphas: list, seed=42, n_jobs: int = 1):
+    """
+    Run Ridge Regression for a grid of alphas on the same 10 folds as run_ridge. Every fold is decomposed once and
+    solved for all alphas.
 
-        model = Ridge(alpha)
-        model.fit(x_train_fold, y_train_fold)
-        y_predict = model.predict(X_out)
-        r2.append(pearsonr(y_out, y_predict)[0]**2)
+    Args:
+    - X (np.array): Features
+    - y (np.array): Consumption
+    - alphas (list): params for Ridge Regression
+    - seed (int): For reproducibility
+    - n_jobs (int): Number of processes for the folds
 
-    y_hest = model.predict(X_out)
-    return np.mean(r2), y_hest, model
+    Return:
+    - pd.Dataframe: mean and std. of the fold r^2 for every alpha
+    - model of the best alpha, None if no alpha has a finite r^2 (e.g. constant folds)
+    """
+    with span("run_ridge_path", rows=len(X)):
+        engine = KFoldRidge(X, y, n_splits=10, seed=seed)
+        r2 = engine.scores_path(alphas, n_jobs)
+        table = pd.DataFrame({"alpha": alphas, "r2": r2.mean(axis=0), "r2_std": r2.std(axis=0)})
+        if not table.r2.notna().any():
+            return table, None
+        best_alpha = table.alpha[table.r2.idxmax()]
+        return table, engine.model(best_alpha)
 
 
 def plot_predictions(y: np.array, yhat: np.array, r2: float, country: str, year: str, n: int, max_y=None, x_label = False):
@@ -155,12 +235,110 @@ def plot_predictions(y: np.array, yhat: np.array, r2: float, country: str, year:
 
     return fig
 
+def standardize_groups(X: np.array, offsets: np.array) -> None:
+    """
+    Standardize the rows of X group-wise in place, same as fitting a StandardScaler on every group.
+
+    Args:
+    - X (np.array): float matrix, the rows of a group are contiguous
+    - offsets (np.array): start row of every group followed by len(X)
+    """
+    counts = np.diff(offsets)
+    starts = offsets[:-1]
+    if len(X) == 0 or np.any(counts == 0):
+        raise ValueError("Can't standardize an empty group")
+
+    means = np.add.reduceat(X, starts, axis=0) / counts[:, None]
+    X -= np.repeat(means, counts, axis=0)
+    scale = np.sqrt(np.add.reduceat(X**2, starts, axis=0) / counts[:, None])
+    scale[scale < 10 * np.finfo(scale.dtype).eps] = 1.0  # constant features, like sklearn
+    X /= np.repeat(scale, counts, axis=0)
+
+
+class FeatureIndex:
+
+    @profiled("FeatureIndex.build")
+    def __init__(self, df: pd.DataFrame, osm_cols: list) -> None:
+        """
+        Index of the (country, year) groups of a dataframe. The dataframe is sorted once by country and year
+        (keeping the row order within a group) and the CNN, OSM and consumption values are kept as dense arrays,
+        so building features for any selection of groups only copies slices. Build it once and pass it as `index`
+        to the get_*features functions to reuse it across runs.
+
+        Args:
+        - df (pd.Dataframe): Dataframe with data
+        - osm_cols (list): Columns for OSM features
+        """
+        country_codes, self.countries = pd.factorize(df["country"], sort=True)
+        years = df["year"].to_numpy()
+        order = np.lexsort((years, country_codes))
+        country_codes, years = country_codes[order], years[order]
+
+        sorted_df = df.iloc[order]
+        self.osm_cols = list(osm_cols)
+        self.cnn = get_cnn_features(sorted_df)
+        self.osm = sorted_df[self.osm_cols].to_numpy()
+        self.cons = sorted_df["cons_pc"].to_numpy()
+
+        change = np.flatnonzero((country_codes[1:] != country_codes[:-1]) | (years[1:] != years[:-1])) + 1
+        starts = np.concatenate(([0], change)) if len(df) else np.array([], dtype=int)
+        ends = np.append(starts[1:], len(df)).astype(int)
+        self.groups = {(self.countries[country_codes[s]], years[s].item()): (s, e) for s, e in zip(starts, ends)}
+        set_rows(len(df))
+
+    def years(self, country: str) -> list:
+        """
+        Return the sorted survey years of a country.
+        """
+        return sorted(year for c, year in self.groups if c == country)
+
+    @profiled(rows=lambda result: len(result[1]))
+    def assemble(self, groups: list, infl=1, scale_cnn: bool = True, scale_complete: bool = True, log_transform: bool = True):
+        """
+        Build the feature matrix for the groups in the given order.
+
+        Args:
+        - groups (list): (country, year) tuples
+        - infl (float or list): inflation rate for scaling, either one for all groups or one per group
+        - scale_cnn (bool): standard. CNN features per group
+        - scale_complete (bool): standard. combined features
+        - log_transform (bool): Log Transform cons.
+
+        Return:
+        - X (np.array): features
+        - y (np.array): cons.
+        """
+        slices = [self.groups.get(group, (0, 0)) for group in groups]
+        counts = np.array([e - s for s, e in slices], dtype=int)
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        n_cnn = self.cnn.shape[1]
+        infl = np.broadcast_to(np.asarray(infl, dtype=np.float64), (len(groups),))
+
+        X = np.empty((offsets[-1], n_cnn + len(self.osm_cols)), dtype=np.float64)
+        y = np.empty(offsets[-1], dtype=self.cons.dtype)
+        for (s, e), start, end, rate in zip(slices, offsets[:-1], offsets[1:], infl):
+            X[start:end, :n_cnn] = self.cnn[s:e]
+            X[start:end, n_cnn:] = self.osm[s:e]
+            y[start:end] = self.cons[s:e] / rate
+
+        if scale_cnn:
+            standardize_groups(X[:, :n_cnn], offsets)
+        if scale_complete:
+            standardize_groups(X, offsets[[0, -1]])
+        if log_transform:
+            y = np.log(y)
+
+        return X, y
+
+
 def get_inflation_perf(country, base, target):
-    base_infl = wb.get_series("FP.CPI.TOTL", country=country, date=base)[0]
-    target_infl = wb.get_series("FP.CPI.TOTL", country=country, date=target)[0]
+    store = get_store()
+    base_infl = store.get(CPI, country, base)
+    target_infl = store.get(CPI, country, target)
     return target_infl / base_infl
 
-def get_recent_features(df: pd.DataFrame, countries: list, osm_cols: list, infl: int = 1, scale_cnn: bool = True, scale_complete: bool = True, log_transform = True):
+@profiled(rows=lambda result: len(result[1]))
+def get_recent_features(df: pd.DataFrame, countries: list, osm_cols: list, infl: int = 1, scale_cnn: bool = True, scale_complete: bool = True, log_transform = True, index: FeatureIndex = None):
     """
     Return features from most recent survey for a country.
 
@@ -172,48 +350,20 @@ def get_recent_features(df: pd.DataFrame, countries: list, osm_cols: list, infl:
     - scale_cnn (bool): standard. CNN features
     - scale_complete (bool): standard. combined features
     - log_transform (bool): Log Transform cons. 
+    - index (FeatureIndex): Prebuilt index of df, built on the fly if None
 
     Return:
     - X (np.array): features
     - y (np.array): cons.
     """
-    X = None
-    y = None
-
-    for country in countries:
-        tmp_df = df.loc[df.country == country]
-        
-        years = tmp_df.groupby(["year"]).groups.keys()
-        year = max(years)
-        year_df = tmp_df.loc[tmp_df.year == year]
-        cnn_X = np.array([np.array(x) for x in year_df["features"].values])
-        
-        if scale_cnn:
-            cnn_X = StandardScaler().fit_transform(cnn_X)
-        osm_X = year_df[osm_cols].values
-        tmp_X = np.hstack((cnn_X, osm_X))
-        y_ = year_df["cons_pc"].values
+    if index is None:
+        index = FeatureIndex(df, osm_cols)
 
-        if X is None:
-            X = tmp_X
-        else:
-            X = np.vstack((X, tmp_X))
-        if y is None:
-            y = y_
-        else:
-            y = np.append(y, y_)
-
-    if scale_complete:
-        X = StandardScaler().fit_transform(X)
-    
-    y /= infl
-
-    if log_transform:
-        y = np.log(y)
-
-    return X, y
+    groups = [(country, max(index.years(country))) for country in countries]
+    return index.assemble(groups, infl, scale_cnn, scale_complete, log_transform)
 
-def get_features(df: pd.DataFrame, countries: list, years: list, osm_cols: list, infl: int = 1, scale_cnn: bool = True, scale_complete: bool = True, log_transform = True):
+@profiled(rows=lambda result: len(result[1]))
+def get_features(df: pd.DataFrame, countries: list, years: list, osm_cols: list, infl: int = 1, scale_cnn: bool = True, scale_complete: bool = True, log_transform = True, index: FeatureIndex = None):
     """
     Return features for a country by given years..
 
@@ -226,48 +376,20 @@ def get_features(df: pd.DataFrame, countries: list, years: list, osm_cols: list,
     - scale_cnn (bool): standard. CNN features
     - scale_complete (bool): standard. combined features
     - log_transform (bool): Log Transform cons. 
+    - index (FeatureIndex): Prebuilt index of df, built on the fly if None
 
     Return:
     - X (np.array): features
     - y (np.array): cons.
     """
-    X = None
-    y = None
+    if index is None:
+        index = FeatureIndex(df, osm_cols)
 
-    for country in countries:
-        tmp_df = df.loc[df.country == country]
-        
-        for year in years:
-        
-            year_df = tmp_df.loc[tmp_df.year == year]
-            cnn_X = np.array([np.array(x) for x in year_df["features"].values])
-            
-            if scale_cnn:
-                cnn_X = StandardScaler().fit_transform(cnn_X)
-            osm_X = year_df[osm_cols].values
-            tmp_X = np.hstack((cnn_X, osm_X))
-            y_ = year_df["cons_pc"].values
-
-            if X is None:
-                X = tmp_X
-            else:
-                X = np.vstack((X, tmp_X))
-            if y is None:
-                y = y_
-            else:
-                y = np.append(y, y_)
-
-    if scale_complete:
-        X = StandardScaler().fit_transform(X)
-    
-    y /= infl
-
-    if log_transform:
-        y = np.log(y)
-
-    return X, y
-
-def get_features_allyears(complete_df, countries, osm_colls):
+    groups = [(country, year) for country in countries for year in years]
+    return index.assemble(groups, infl, scale_cnn, scale_complete, log_transform)
+
+@profiled(rows=lambda result: len(result[1]))
+def get_features_allyears(complete_df, countries, osm_colls, index: FeatureIndex = None):
     """
     Return features for a country with all years in dataset. All data is scaled to inflation rate from 2010 on.
 
@@ -275,35 +397,153 @@ def get_features_allyears(complete_df, countries, osm_colls):
     - df (pd.Dataframe): Dataframe with data
     - countries (list): Countries for which data is requested
     - osm_cols (list): Columns for OSM features
+    - index (FeatureIndex): Prebuilt index of df, built on the fly if None
 
     Return:
     - X (np.array): features
     - y (np.array): cons.
     """
-    X = None
-    y = None
+    if index is None:
+        index = FeatureIndex(complete_df, osm_colls)
+
+    groups = [(country, year) for country in countries for year in index.years(country)]
+    infl = [get_inflation_perf(country, 2010, year) for country, year in groups]
+    return index.assemble(groups, infl, scale_cnn=False)
+
+
+@dataclass(frozen=True)
+class FeatureSet:
+    """
+    Description of a feature matrix, used as cache key by run_evaluations.
+
+    - countries (tuple): Countries of the set
+    - years (tuple): Selected years, all years of each country if None
+    - infl_base (int): Deflate cons. to prices of this year (World Bank CPI), no deflation if None
+    - scale_cnn (bool): standard. CNN features per survey
+    """
+    countries: tuple
+    years: tuple = None
+    infl_base: int = None
+    scale_cnn: bool = True
+
+    def build(self, index: FeatureIndex):
+        """
+        Return X, y of the set.
+        """
+        groups = [(country, year) for country in self.countries for year in (self.years or index.years(country))]
+        infl = 1
+        if self.infl_base is not None:
+            infl = [get_inflation_perf(country, self.infl_base, year) for country, year in groups]
+        return index.assemble(groups, infl, scale_cnn=self.scale_cnn)
+
+
+@dataclass(frozen=True)
+class Evaluation:
+    """
+    A ridge run: 10-fold CV r^2 on train (like run_ridge) if test is None, otherwise r^2 of the fold models on test
+    (like run_ridge_out).
+    """
+    train: FeatureSet
+    test: FeatureSet = None
+    alpha: float = 1000
+
+
+def _run_train_set(args) -> list:
+    """
+    Evaluate all runs sharing one training set, so the folds are only prepared once per seed.
+    """
+    X, y, runs = args
+    engines = {}
+    r2 = []
+    for X_out, y_out, alpha in runs:
+        seed = 42 if X_out is None else 1  # seeds of run_ridge and run_ridge_out
+        if seed not in engines:
+            engines[seed] = KFoldRidge(X, y, n_splits=10, seed=seed)
+        if X_out is None:
+            r2.append(engines[seed].score(alpha))
+        else:
+            r2.append(engines[seed].score_out(X_out, y_out, alpha))
+    return r2
+
+
+@profiled(rows=len)
+def run_evaluations(df: pd.DataFrame, osm_cols: list, evaluations: list, n_jobs: int = 1, index: FeatureIndex = None) -> pd.DataFrame:
+    """
+    Run many ridge evaluations. Every distinct feature set is built once, the runs are grouped by training set and
+    the groups are spread over a process pool.
+
+    Args:
+    - df (pd.Dataframe): Dataframe with data
+    - osm_cols (list): Columns for OSM features
+    - evaluations (list): Evaluation objects
+    - n_jobs (int): Number of processes, 1 runs in this process
+    - index (FeatureIndex): Prebuilt index of df, built on the fly if None
 
-    for country in countries:        
-        tmp_df = complete_df.loc[complete_df.country == country]
-        years = tmp_df.groupby(["year"]).groups.keys()
+    Return:
+    - pd.Dataframe: one row per evaluation with the train and test set and r^2
+    """
+    if index is None:
+        index = FeatureIndex(df, osm_cols)
+
+    features = {}
+    for evaluation in evaluations:
+        for feature_set in (evaluation.train, evaluation.test):
+            if feature_set is not None and feature_set not in features:
+                features[feature_set] = feature_set.build(index)
+
+    by_train = {}
+    for i, evaluation in enumerate(evaluations):
+        by_train.setdefault(evaluation.train, []).append(i)
+    tasks = []
+    for train, positions in by_train.items():
+        runs = []
+        for i in positions:
+            X_out, y_out = features[evaluations[i].test] if evaluations[i].test is not None else (None, None)
+            runs.append((X_out, y_out, evaluations[i].alpha))
+        tasks.append((*features[train], runs))
+
+    if n_jobs == 1:
+        results = [_run_train_set(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            results = list(pool.map(_run_train_set, tasks))
+
+    r2 = np.empty(len(evaluations))
+    for positions, values in zip(by_train.values(), results):
+        r2[positions] = values
+
+    return pd.DataFrame({
+        "train_countries": [e.train.countries for e in evaluations],
+        "train_years": [e.train.years for e in evaluations],
+        "eval_countries": [(e.test or e.train).countries for e in evaluations],
+        "eval_years": [(e.test or e.train).years for e in evaluations],
+        "alpha": [e.alpha for e in evaluations],
+        "r2": r2,
+    })
+
+
+def time_travel_evaluations(index: FeatureIndex, countries: list, alpha: float = 1000, alpha_out: float = 10000) -> list:
+    """
+    Evaluations of the time travel experiment: for every country train on each survey year and evaluate on every
+    year, with the cons. of the evaluation year deflated to the training year.
+
+    Args:
+    - index (FeatureIndex): Index of the data
+    - countries (list): Countries
+    - alpha (float): param for Ridge Regression if train and eval year are the same
+    - alpha_out (float): param for Ridge Regression across years
+
+    Return:
+    - list: Evaluation objects
+    """
+    evaluations = []
+    for country in countries:
+        years = index.years(country)
         for year in years:
-            
-            year_df = tmp_df.loc[tmp_df.year == year]
-            cnn_X = np.array([np.array(x) for x in year_df["features"].values])
-            osm_X = year_df[osm_colls].values
-            tmp_X = np.hstack((cnn_X, osm_X))
-            y_ = year_df["cons_pc"].values
-            inflr = get_inflation_perf(country, 2010, year)
-            y_ = y_ / inflr
-            if X is None:
-                X = tmp_X
-            else:
-                X = np.vstack((X, tmp_X))
-            
-            if y is None:
-                y = y_
-            else:
-                y = np.append(y, y_)
-
-    X = StandardScaler().fit_transform(X)
-    return X, np.log(y)
\ No newline at end of file
+            train = FeatureSet((country,), (year,))
+            for x_year in years:
+                if x_year == year:
+                    evaluations.append(Evaluation(train, alpha=alpha))
+                else:
+                    evaluations.append(Evaluation(train, FeatureSet((country,), (x_year,), infl_base=year), alpha_out))
+    return evaluations
@@ -0,0 +1,290 @@
+"""
+Scheduler for the Earth Engine patch exports of 0_download_satellite.ipynb.
+
+The clusters of every (country, year) survey are split into export jobs (one TFRecord file each). The scheduler keeps
+at most max_running exports active, submits the next job when one finishes and polls the states of all running
+exports with one task list request. A failed export is resubmitted with its points split into two halves (Earth
+Engine mostly fails on memory), down to min_points, and after max_attempts tries of the same points it is given up.
+
+The jobs and their task ids are persisted in a JSON state file after every change. After a crash, a new scheduler on
+the same file picks up the running exports by their ids instead of exporting again.
+
+The export itself is a callable job -> started ee.batch.Task (see export_chunk in the notebook), and the polling a
+callable task ids -> status dicts, so the scheduler can run against FakeTask instead of Earth Engine.
+"""
+from __future__ import annotations
+
+import itertools
+import json
+import math
+import os
+import time
+from dataclasses import asdict, dataclass, field
+
+import pandas as pd
+from tqdm.auto import tqdm
+
+PENDING = "PENDING"  # not submitted yet
+SUBMITTED = "SUBMITTED"  # export started, not finished
+COMPLETED = "COMPLETED"
+FAILED = "FAILED"  # failed max_attempts times
+SPLIT = "SPLIT"  # failed and replaced by two smaller jobs
+DONE_STATES = {COMPLETED, FAILED, SPLIT}
+# Earth Engine task states which end an export without a file, failed ones are retried, cancelled ones not
+TASK_FAILED_STATES = {"FAILED", "UNKNOWN"}
+TASK_CANCELLED_STATES = {"CANCELLED", "CANCEL_REQUESTED"}
+
+
+@dataclass
+class ExportJob:
+    """
+    Export of the patches of some clusters of one survey into one TFRecord file.
+
+    - name: file name of the export, unique
+    - rows: index labels of the clusters in the survey dataframe
+    - parent: name of the job this one was split from
+    """
+    name: str
+    country: str
+    year: int
+    rows: list
+    state: str = PENDING
+    task_id: str | None = None
+    attempts: int = 0
+    error: str | None = None
+    parent: str | None = None
+    submitted: float | None = None
+    finished: float | None = None
+
+
+def survey_jobs(df: pd.DataFrame, chunk_size: int | None = None, max_bytes: int | None = None) -> list:
+    """
+    Split the clusters of every (country, year) survey into export jobs named {country}_{year}_{i:02d}.
+
+    Args:
+    - df (pd.Dataframe): Clusters with the columns country and year
+    - chunk_size (int): Maximal clusters per job, one job per survey if None
+    - max_bytes (int): Maximal estimated request size of the clusters of a job (see satellite_utils.plan_chunks), no
+      limit if None
+
+    Return:
+    - list: ExportJob
+    """
+    jobs = []
+    for (country, year), rows in df.groupby(["country", "year"], sort=True).groups.items():
+        rows = list(rows)
+        if max_bytes is None:
+            size = chunk_size or len(rows)
+            parts = [rows[i * size:(i + 1) * size] for i in range(math.ceil(len(rows) / size))]
+        else:
+            from lib.satellite_utils import plan_chunks  # needs Earth Engine
+
+            parts = [chunk.rows for chunk in plan_chunks(df.loc[rows], chunk_size, max_bytes)]
+        for i, part in enumerate(parts):
+            jobs.append(ExportJob(f"{country}_{year}_{i:02d}", country, int(year), [int(row) for row in part]))
+    return jobs
+
+
+def ee_statuses(task_ids: list) -> dict:
+    """
+    Status of Earth Engine tasks, from one task list request. Tasks missing in the list are asked one by one.
+
+    Args:
+    - task_ids (list): Task ids
+
+    Return:
+    - dict: task id -> status dict (state, error_message, ...)
+    """
+    import ee
+
+    wanted = set(task_ids)
+    statuses = {status["id"]: status for status in ee.data.getTaskList() if status["id"] in wanted}
+    missing = [task_id for task_id in task_ids if task_id not in statuses]
+    if missing:
+        statuses.update({status["id"]: status for status in ee.data.getTaskStatus(missing)})
+    return statuses
+
+
+class ExportScheduler:
+
+    def __init__(self, submit, state_path: str, max_running: int = 10, poll=ee_statuses, poll_interval: float = 20,
+                 max_attempts: int = 3, min_points: int = 10, sleep=time.sleep, show_progbar: bool = True) -> None:
+        """
+        Scheduler of export jobs, resumed from state_path if it exists.
+
+        Args:
+        - submit: function ExportJob -> started ee.batch.Task (or anything with an id)
+        - state_path (str): JSON file of the job states
+        - max_running (int): Maximal number of exports at the same time
+        - poll: function list of task ids -> dict task id -> status, ee_statuses by default
+        - poll_interval (float): Seconds between polls
+        - max_attempts (int): Tries of the same points before a job is given up
+        - min_points (int): Failed jobs with more points are split instead of retried
+        - sleep: function used to wait between polls
+        - show_progbar (bool): Display the finished jobs as progress bar
+        """
+        self.submit = submit
+        self.state_path = state_path
+        self.max_running = max_running
+        self.poll = poll
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.min_points = min_points
+        self.sleep = sleep
+        self.show_progbar = show_progbar
+        self.jobs: dict = {}
+        if os.path.isfile(state_path):
+            with open(state_path, "r") as f:
+                self.jobs = {job["name"]: ExportJob(**job) for job in json.load(f)["jobs"]}
+
+    def save(self) -> None:
+        """
+        Write the job states.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(self.state_path)), exist_ok=True)
+        with open(self.state_path + ".tmp", "w") as f:
+            json.dump({"jobs": [asdict(job) for job in self.jobs.values()]}, f, indent=4)
+        os.replace(self.state_path + ".tmp", self.state_path)
+
+    def add(self, jobs: list) -> None:
+        """
+        Add jobs, the ones which are already known (e.g. from a resumed state) are kept as they are.
+        """
+        for job in jobs:
+            self.jobs.setdefault(job.name, job)
+        self.save()
+
+    def by_state(self, state: str) -> list:
+        return [job for job in self.jobs.values() if job.state == state]
+
+    def _fail(self, job: ExportJob, error: str, progbar) -> None:
+        job.attempts += 1
+        job.error = error
+        job.task_id = None
+        job.finished = time.time()
+        if len(job.rows) > self.min_points:
+            job.state = SPLIT
+            half = math.ceil(len(job.rows) / 2)
+            for i, rows in enumerate([job.rows[:half], job.rows[half:]]):
+                child = ExportJob(f"{job.name}_{i}", job.country, job.year, rows, parent=job.name)
+                self.jobs[child.name] = child
+            progbar.write(f"Export {job.name} failed ({error}), split into {job.name}_0 and {job.name}_1")
+        elif job.attempts >= self.max_attempts:
+            job.state = FAILED
+            progbar.write(f"Export {job.name} failed {job.attempts} times, giving up: {error}")
+        else:
+            job.state = PENDING
+            progbar.write(f"Export {job.name} failed ({error}), retrying")
+
+    def _update(self, progbar) -> None:
+        """
+        Poll all submitted jobs at once and handle the finished ones.
+        """
+        submitted = self.by_state(SUBMITTED)
+        if not submitted:
+            return
+        statuses = self.poll([job.task_id for job in submitted])
+        for job in submitted:
+            status = statuses.get(job.task_id, {"state": "UNKNOWN"})
+            if status["state"] == "COMPLETED":
+                job.state = COMPLETED
+                job.finished = time.time()
+                progbar.write(f"Export {job.name} finished in {int((job.finished - (job.submitted or job.finished)) / 60)} min")
+            elif status["state"] in TASK_FAILED_STATES:
+                self._fail(job, status.get("error_message", status["state"]), progbar)
+            elif status["state"] in TASK_CANCELLED_STATES:
+                job.state = FAILED
+                job.error = status["state"]
+                job.finished = time.time()
+                progbar.write(f"Export {job.name} was cancelled")
+
+    def _submit_pending(self, progbar) -> None:
+        slots = self.max_running - len(self.by_state(SUBMITTED))
+        for job in itertools.islice(self.by_state(PENDING), max(slots, 0)):
+            try:
+                task = self.submit(job)
+            except Exception as e:  # e.g. too many running tasks, the job is tried again after the next poll
+                job.attempts += 1
+                job.error = f"submit: {e}"
+                if job.attempts >= self.max_attempts:
+                    job.state = FAILED
+                progbar.write(f"Export {job.name} could not be submitted: {e}")
+                self.save()
+                break
+            job.task_id = task.id
+            job.state = SUBMITTED
+            job.submitted = time.time()
+            self.save()
+
+    def run(self) -> pd.DataFrame:
+        """
+        Submit and poll until every job has completed or failed.
+
+        Return:
+        - pd.Dataframe: summary(), one row per job
+        """
+        progbar = tqdm(total=len(self.jobs), disable=not self.show_progbar)
+        while True:
+            self._update(progbar)
+            self._submit_pending(progbar)
+            self.save()
+            progbar.total = len(self.jobs)
+            progbar.n = sum(job.state in DONE_STATES for job in self.jobs.values())
+            progbar.refresh()
+            if not self.by_state(SUBMITTED) and not self.by_state(PENDING):
+                break
+            self.sleep(self.poll_interval)
+        progbar.close()
+        return self.summary()
+
+    def summary(self) -> pd.DataFrame:
+        """
+        Return:
+        - pd.Dataframe: name, country, year, number of points, state, attempts and error of every job
+        """
+        return pd.DataFrame([{"name": job.name, "country": job.country, "year": job.year, "points": len(job.rows),
+                              "state": job.state, "attempts": job.attempts, "error": job.error, "parent": job.parent}
+                             for job in self.jobs.values()])
+
+
+@dataclass
+class FakeTask:
+    """
+    Local stand-in for ee.batch.Task. The task is READY when created, RUNNING after start() and finishes with
+    final_state after `polls` status requests.
+    """
+    id: str
+    final_state: str = "COMPLETED"
+    polls: int = 1
+    error_message: str = "Computation timed out."
+    started: bool = False
+    requests: int = field(default=0, repr=False)
+
+    def start(self) -> None:
+        self.started = True
+
+    def status(self) -> dict:
+        if not self.started:
+            return {"id": self.id, "state": "READY"}
+        self.requests += 1
+        if self.requests < self.polls:
+            return {"id": self.id, "state": "RUNNING"}
+        status = {"id": self.id, "state": self.final_state}
+        if self.final_state == "FAILED":
+            status["error_message"] = self.error_message
+        return status
+
+
+def task_statuses(tasks: dict):
+    """
+    Poll function over task objects (e.g. FakeTask) instead of Earth Engine.
+
+    Args:
+    - tasks (dict): task id -> task, filled by the submit function
+
+    Return:
+    - function list of task ids -> dict task id -> status
+    """
+    def poll(task_ids: list) -> dict:
+        return {task_id: tasks[task_id].status() for task_id in task_ids if task_id in tasks}
+    return poll
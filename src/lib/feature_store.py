@@ -0,0 +1,110 @@
+"""
+Binary feature store for the CNN embeddings.
+
+A store is a directory containing
+- features.npy: float32 matrix with one embedding per row, loaded memory-mapped
+- index.parquet: scalar columns (year, lat, lon, nightlight, ...) in the same row order
+"""
+from __future__ import annotations
+
+import ast
+import os
+
+import numpy as np
+import pandas as pd
+
+FEATURES_FILE = "features.npy"
+INDEX_FILE = "index.parquet"
+CNN_PREFIX = "cnn_"
+
+
+def cnn_columns(n_features: int) -> list:
+    """
+    Column names used for the embedding dimensions once they are part of a dataframe.
+
+    Args:
+    - n_features (int): Width of the embedding
+
+    Return:
+    - list: names cnn_0 ... cnn_{n-1}
+    """
+    return [f"{CNN_PREFIX}{i}" for i in range(n_features)]
+
+
+def is_feature_store(path: str) -> bool:
+    """
+    Check if the path points to a feature store directory.
+
+    Args:
+    - path (str): Path to check
+
+    Return:
+    - bool: True if both the matrix and the index exist
+    """
+    return os.path.isfile(os.path.join(path, FEATURES_FILE)) and os.path.isfile(os.path.join(path, INDEX_FILE))
+
+
+def write_feature_store(path: str, features: np.ndarray, index: pd.DataFrame) -> None:
+    """
+    Write the embeddings and their index into a feature store.
+
+    Args:
+    - path (str): Directory of the store, created if missing
+    - features (np.array): Embeddings with shape (n, n_features)
+    - index (pd.Dataframe): Scalar columns, one row per embedding
+    """
+    if len(features) != len(index):
+        raise ValueError(f"features has {len(features)} rows but index has {len(index)}")
+
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, FEATURES_FILE), np.ascontiguousarray(features, dtype=np.float32))
+    index.reset_index(drop=True).to_parquet(os.path.join(path, INDEX_FILE), index=False)
+
+
+def convert_csv(csv_path: str, path: str, features_col: str = "features") -> None:
+    """
+    Convert a CNN feature CSV (as written by 1_cnn.ipynb) into a feature store.
+    This is the only place the list literals are parsed.
+
+    Args:
+    - csv_path (str): Path to CSV file
+    - path (str): Directory of the store
+    - features_col (str): Column which contains the embeddings
+    """
+    cnn = pd.read_csv(csv_path, converters={features_col: ast.literal_eval})
+    features = np.array(cnn[features_col].to_list(), dtype=np.float32)
+    write_feature_store(path, features, cnn.drop(columns=[features_col]))
+
+
+def load_feature_store(path: str, mmap: bool = True):
+    """
+    Load a feature store.
+
+    Args:
+    - path (str): Directory of the store
+    - mmap (bool): Memory-map the matrix instead of reading it into RAM
+
+    Return:
+    - pd.Dataframe: index
+    - np.array: float32 embeddings, row i belongs to index row i
+    """
+    features = np.load(os.path.join(path, FEATURES_FILE), mmap_mode="r" if mmap else None)
+    index = pd.read_parquet(os.path.join(path, INDEX_FILE))
+    return index, features
+
+
+def load_feature_frame(path: str, mmap: bool = True) -> pd.DataFrame:
+    """
+    Load a feature store as one dataframe, with the embedding spread over cnn_* columns.
+    The columns wrap the (memory-mapped) matrix as a single float32 block, no per-row objects are created.
+
+    Args:
+    - path (str): Directory of the store
+    - mmap (bool): Memory-map the matrix instead of reading it into RAM
+
+    Return:
+    - pd.Dataframe: index columns followed by the cnn_* columns
+    """
+    index, features = load_feature_store(path, mmap)
+    frame = pd.DataFrame(features, columns=cnn_columns(features.shape[1]), copy=False)
+    return pd.concat([index, frame], axis=1)
@@ -0,0 +1,140 @@
+"""
+Offline cache for the World Bank indicators (PPP and CPI) used by lsms.py and estimator_util.py.
+
+Every lookup is served from memory. Misses are filled from a persistent CSV file, and only if the value is not there
+the source is asked for the complete series of the country, which is then written back to the file. With a filled
+cache file the pipeline does not need any network access.
+"""
+from __future__ import annotations
+
+import math
+import os
+
+import pandas as pd
+import world_bank_data as wb
+
+PPP = "PA.NUS.PRVT.PP"
+CPI = "FP.CPI.TOTL"
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "data", "world_bank", "indicators.csv")
+
+
+def world_bank_source(indicator: str, country: str) -> dict:
+    """
+    Fetch the complete series of an indicator for a country from the World Bank API.
+
+    Args:
+    - indicator (str): World Bank indicator code
+    - country (str): Country code
+
+    Return:
+    - dict: year -> value
+    """
+    series = wb.get_series(indicator, country=country, id_or_value="id", simplify_index=True)
+    return {int(year): value for year, value in series.items()}
+
+
+def frame_source(df: pd.DataFrame):
+    """
+    Source serving the values of a dataframe with the columns indicator, country, year and value.
+    Can be used as local stand-in for the World Bank API.
+
+    Args:
+    - df (pd.Dataframe): Indicator values
+
+    Return:
+    - source function
+    """
+    def source(indicator: str, country: str) -> dict:
+        rows = df.loc[(df.indicator == indicator) & (df.country == country)]
+        return dict(zip(rows.year.astype(int), rows.value))
+    return source
+
+
+class IndicatorStore:
+
+    def __init__(self, path: str = DEFAULT_PATH, source=world_bank_source) -> None:
+        """
+        Persistent indicator cache.
+
+        Args:
+        - path (str): CSV file of the cache, created on the first fetch
+        - source: function (indicator, country) -> dict year -> value, used for misses. None disables fetching.
+        """
+        self.path = path
+        self.source = source
+        self.values: dict = {}
+        self.fetched: set = set()
+        if os.path.isfile(path):
+            df = pd.read_csv(path)
+            for indicator, country, year, value in df[["indicator", "country", "year", "value"]].itertuples(index=False):
+                self.values[(indicator, country, int(year))] = value
+                self.fetched.add((indicator, country))
+
+    def get(self, indicator: str, country: str, year: int) -> float | None:
+        """
+        Return the value of an indicator.
+
+        Args:
+        - indicator (str): World Bank indicator code
+        - country (str): Country code
+        - year (int): Year
+
+        Return:
+        - float: value, None if the World Bank has no value
+        """
+        key = (indicator, country, int(year))
+        if key not in self.values and (indicator, country) not in self.fetched and self.source is not None:
+            self.fetch(indicator, country)
+
+        value = self.values.get(key)
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            return None
+        return value
+
+    def fetch(self, indicator: str, country: str) -> None:
+        """
+        Load the complete series of the indicator for the country from the source and persist it.
+        """
+        for year, value in self.source(indicator, country).items():
+            self.values[(indicator, country, int(year))] = value
+        self.fetched.add((indicator, country))
+        self.write()
+
+    def prefetch(self, indicators: list, countries: list) -> None:
+        """
+        Bulk fetch the series of all indicators for all countries, for example before going offline.
+        """
+        for indicator in indicators:
+            for country in countries:
+                if (indicator, country) not in self.fetched:
+                    self.fetch(indicator, country)
+
+    def write(self) -> None:
+        """
+        Write the cache file.
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        rows = [(indicator, country, year, value) for (indicator, country, year), value in self.values.items()]
+        df = pd.DataFrame(rows, columns=["indicator", "country", "year", "value"])
+        df.sort_values(["indicator", "country", "year"]).to_csv(self.path, index=False)
+
+
+_store: IndicatorStore | None = None
+
+
+def get_store() -> IndicatorStore:
+    """
+    Return the store shared by the library, created with the default path and source on first use.
+    """
+    global _store
+    if _store is None:
+        _store = IndicatorStore()
+    return _store
+
+
+def set_store(store: IndicatorStore) -> None:
+    """
+    Replace the shared store, e.g. by one with another path or a local source.
+    """
+    global _store
+    _store = store
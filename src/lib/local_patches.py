@@ -0,0 +1,300 @@
+"""
+Local backend of the patch export (satellite_utils.get_array_patches), without Earth Engine.
+
+Given raster mosaics of a year (e.g. a Landsat median composite with the MS bands and a nightlights composite) and the
+LSMS clusters, every cluster gets a 255 x 255 patch per band on the grid of the Earth Engine export: EPSG:3857 at 30 m,
+centered on the pixel which contains the cluster. The rasters are mapped onto that grid by nearest neighbour, so
+mosaics in EPSG:3857 or EPSG:4326 and with other resolutions (nightlights) can be combined. Only the window around a
+cluster is read: NumPy mosaics are memory-mapped, GeoTIFFs are read with windowed reads (needs rasterio). Pixels
+outside of a mosaic or missing (NaN) are 0, as the default value of TfrecordHelper.
+
+The patches are written as GZIP TFRecords with the schema TfrecordHelper expects: every band as 255*255 floats, the
+numeric columns of the clusters (lat, lon, year, ...) as floats and the others as bytes. The clusters of a survey are
+split into files {country}_{year}_{i:02d}.tfrecord.gz like the exports, and the files are written in parallel by a
+process pool. Files which exist are skipped, so an interrupted run can be repeated.
+
+NumPy mosaics are a .npy file with shape (bands, height, width) plus a .json file with the band names, the CRS and the
+GDAL geotransform (x0, dx, 0, y0, 0, dy), see write_npy_raster.
+"""
+from __future__ import annotations
+
+import json
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from lib import profiling
+
+PATCH_SIZE = 255
+SCALE = 30
+REQUIRED_BANDS = ["RED", "GREEN", "BLUE", "SWIR1", "SWIR2", "TEMP1", "NIR", "NIGHTLIGHTS"]
+EARTH_RADIUS = 6378137.0  # of the EPSG:3857 sphere
+# zlib level of the TFRecords, the default (6) takes ~10x longer than level 1 for 15% smaller files
+COMPRESSION_LEVEL = 1
+
+
+@dataclass(frozen=True)
+class Raster:
+    """
+    A mosaic on disk, a .npy file (see write_npy_raster) or a GeoTIFF.
+
+    - path: file of the mosaic
+    - bands: names of the bands in order, from the .json file or the GeoTIFF band descriptions if None
+    """
+    path: str
+    bands: tuple | None = None
+
+
+def write_npy_raster(path: str, array: np.ndarray, transform: tuple, bands: list, crs: str = "EPSG:3857") -> None:
+    """
+    Write a NumPy mosaic.
+
+    Args:
+    - path (str): .npy file, the metadata is written next to it as .json
+    - array (np.array): Mosaic with shape (bands, height, width)
+    - transform (tuple): GDAL geotransform (x0, dx, 0, y0, 0, dy) of the upper left corner, dy is negative
+    - bands (list): Band names
+    - crs (str): "EPSG:3857" or "EPSG:4326"
+    """
+    if array.ndim != 3 or array.shape[0] != len(bands):
+        raise ValueError(f"array has shape {array.shape} but there are {len(bands)} bands")
+    np.save(path, array)
+    with open(os.path.splitext(path)[0] + ".json", "w") as f:
+        json.dump({"bands": list(bands), "crs": crs, "transform": list(transform)}, f, indent=4)
+
+
+def mercator(lat: np.ndarray, lon: np.ndarray):
+    """
+    EPSG:4326 -> EPSG:3857.
+    """
+    x = EARTH_RADIUS * np.radians(lon)
+    y = EARTH_RADIUS * np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))
+    return x, y
+
+
+def inverse_mercator(x: np.ndarray, y: np.ndarray):
+    """
+    EPSG:3857 -> EPSG:4326, returns lat, lon.
+    """
+    lon = np.degrees(x / EARTH_RADIUS)
+    lat = np.degrees(2 * np.arctan(np.exp(y / EARTH_RADIUS)) - np.pi / 2)
+    return lat, lon
+
+
+def patch_grid(lat: float, lon: float, size: int = PATCH_SIZE, scale: float = SCALE):
+    """
+    Pixel centers of the patch of a point on the export grid (EPSG:3857, pixels of `scale` m aligned to the origin).
+    The grid is separable, x only depends on the column and y only on the row.
+
+    Return:
+    - np.array: x of the columns (west to east)
+    - np.array: y of the rows (north to south)
+    """
+    x, y = mercator(lat, lon)
+    offsets = np.arange(size) - size // 2
+    xs = (math.floor(x / scale) + offsets + 0.5) * scale
+    ys = (math.floor(y / scale) - offsets + 0.5) * scale
+    return xs, ys
+
+
+class RasterReader:
+
+    def __init__(self, raster: Raster) -> None:
+        """
+        Open a mosaic for windowed reads, memory-mapped (.npy) or with rasterio (GeoTIFF).
+        """
+        self.dataset = None
+        if raster.path.endswith(".npy"):
+            with open(os.path.splitext(raster.path)[0] + ".json", "r") as f:
+                meta = json.load(f)
+            self.array = np.load(raster.path, mmap_mode="r")
+            self.bands = list(raster.bands or meta["bands"])
+            self.crs = meta["crs"]
+            self.transform = tuple(meta["transform"])
+            self.height, self.width = self.array.shape[1:]
+        else:
+            try:
+                import rasterio
+            except ImportError as e:
+                raise ImportError("Reading GeoTIFF mosaics needs rasterio, or convert them with write_npy_raster") from e
+            self.dataset = rasterio.open(raster.path)
+            self.bands = list(raster.bands or self.dataset.descriptions)
+            self.crs = self.dataset.crs.to_string()
+            self.transform = tuple(self.dataset.transform.to_gdal())
+            self.height, self.width = self.dataset.height, self.dataset.width
+        if self.crs not in ("EPSG:3857", "EPSG:4326"):
+            raise ValueError(f"{raster.path}: CRS {self.crs} is not supported, use EPSG:3857 or EPSG:4326")
+        if None in self.bands or "" in self.bands:
+            raise ValueError(f"{raster.path}: band names are missing")
+
+    def _read_window(self, row0: int, row1: int, col0: int, col1: int) -> np.ndarray:
+        if self.dataset is not None:
+            from rasterio.windows import Window
+
+            return self.dataset.read(window=Window(col0, row0, col1 - col0, row1 - row0))
+        return np.asarray(self.array[:, row0:row1, col0:col1])
+
+    def patch(self, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        """
+        Sample the mosaic at the pixel centers of a patch (see patch_grid) by nearest neighbour.
+
+        Return:
+        - np.array: float32 patch with shape (bands, len(ys), len(xs)), 0 outside of the mosaic and for NaN
+        """
+        if self.crs == "EPSG:4326":
+            lats, _ = inverse_mercator(np.zeros_like(ys), ys)
+            _, lons = inverse_mercator(xs, np.zeros_like(xs))
+            xs, ys = lons, lats
+        x0, dx, _, y0, _, dy = self.transform
+        cols = np.floor((xs - x0) / dx).astype(np.int64)
+        rows = np.floor((ys - y0) / dy).astype(np.int64)
+        valid_cols = (cols >= 0) & (cols < self.width)
+        valid_rows = (rows >= 0) & (rows < self.height)
+
+        patch = np.zeros((len(self.bands), len(rows), len(cols)), dtype=np.float32)
+        if not valid_cols.any() or not valid_rows.any():
+            return patch
+        row0, row1 = rows[valid_rows].min(), rows[valid_rows].max() + 1
+        col0, col1 = cols[valid_cols].min(), cols[valid_cols].max() + 1
+        window = self._read_window(row0, row1, col0, col1)
+        values = window[:, rows[valid_rows] - row0][:, :, cols[valid_cols] - col0]
+        patch[:, np.flatnonzero(valid_rows)[:, None], np.flatnonzero(valid_cols)] = values
+        return np.nan_to_num(patch, copy=False, nan=0.0)
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _field(number: int, payload: bytes) -> bytes:
+    # length-delimited field (wire type 2)
+    return _varint(number << 3 | 2) + _varint(len(payload)) + payload
+
+
+def _float_feature(values: np.ndarray) -> bytes:
+    # Feature.float_list (2) -> FloatList.value (1), packed little-endian float32
+    return _field(2, _field(1, np.ascontiguousarray(values, dtype="<f4").tobytes()))
+
+
+def _bytes_feature(value: bytes) -> bytes:
+    # Feature.bytes_list (1) -> BytesList.value (1)
+    return _field(1, _field(1, value))
+
+
+def encode_example(features: dict) -> bytes:
+    """
+    Serialize a tf.train.Example. Encoding the float arrays as packed bytes directly is much faster than building the
+    protobuf messages, the bytes are the same as tf.train.Example(...).SerializeToString() up to the order of the keys.
+
+    Args:
+    - features (dict): name -> np.array of floats, float or int (stored as float) or str/bytes
+
+    Return:
+    - bytes
+    """
+    entries = []
+    for name, value in features.items():
+        if isinstance(value, (str, bytes)):
+            feature = _bytes_feature(value.encode() if isinstance(value, str) else value)
+        else:
+            feature = _float_feature(np.atleast_1d(np.asarray(value, dtype=np.float32)).ravel())
+        # Features.feature (1) is a map, every entry has the key (1) and the value (2)
+        entries.append(_field(1, _field(1, name.encode()) + _field(2, feature)))
+    return _field(1, b"".join(entries))
+
+
+def _scalar_properties(row: dict) -> dict:
+    properties = {}
+    for name, value in row.items():
+        if isinstance(value, (bool, np.bool_)):
+            value = float(value)
+        if isinstance(value, (int, float, np.integer, np.floating)):
+            properties[name] = float(value)
+        elif isinstance(value, (str, bytes)):
+            properties[name] = value
+    return properties
+
+
+def _write_chunk(args) -> str:
+    path, rows, rasters, size, scale, compression_level = args
+    import tensorflow as tf
+
+    readers = [RasterReader(raster) for raster in rasters]
+    options = tf.io.TFRecordOptions(compression_type="GZIP", compression_level=compression_level)
+    with profiling.span("local_patches.write_chunk", rows=len(rows)), tf.io.TFRecordWriter(path + ".tmp", options) as writer:
+        for row in rows:
+            xs, ys = patch_grid(row["lat"], row["lon"], size, scale)
+            features = {}
+            for reader in readers:
+                patch = reader.patch(xs, ys)
+                for band, values in zip(reader.bands, patch):
+                    features[band] = values
+            features.update(_scalar_properties(row))
+            writer.write(encode_example(features))
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def check_bands(rasters: list) -> None:
+    """
+    Raise a ValueError if the bands of TfrecordHelper are not all in the rasters.
+    """
+    bands = [band for raster in rasters for band in RasterReader(raster).bands]
+    missing = [band for band in REQUIRED_BANDS if band not in bands]
+    if missing:
+        raise ValueError(f"Bands missing in the rasters: {missing}")
+
+
+def extract_patches(df: pd.DataFrame, rasters: dict, out_path: str, chunk_size: int | None = None, n_jobs: int = 1,
+                    size: int = PATCH_SIZE, scale: float = SCALE, compression_level: int = COMPRESSION_LEVEL) -> list:
+    """
+    Extract the patches of all clusters into GZIP TFRecords, one file per chunk of a (country, year) survey.
+
+    Args:
+    - df (pd.Dataframe): Clusters with the columns country, year, lat and lon (and further properties)
+    - rasters (dict): year -> list of Raster, the mosaics of a year
+    - out_path (str): Output directory
+    - chunk_size (int): Maximal clusters per file, one file per survey if None
+    - n_jobs (int): Number of processes, 1 writes in this process
+    - size (int): Patch size in pixels
+    - scale (float): Pixel size in meters
+    - compression_level (int): zlib level of the files
+
+    Return:
+    - list: all TFRecord files of the clusters, in survey order
+    """
+    os.makedirs(out_path, exist_ok=True)
+    for year in df["year"].unique():
+        check_bands(rasters[int(year)])
+
+    files, tasks = [], []
+    for (country, year), survey in df.groupby(["country", "year"], sort=True):
+        records = survey.to_dict("records")
+        chunk = chunk_size or len(records)
+        for i in range(math.ceil(len(records) / chunk)):
+            path = os.path.join(out_path, f"{country}_{year}_{i:02d}.tfrecord.gz")
+            files.append(path)
+            if not os.path.isfile(path):
+                tasks.append((path, records[i * chunk:(i + 1) * chunk], rasters[int(year)], size, scale,
+                              compression_level))
+
+    with profiling.span("local_patches.extract_patches", rows=sum(len(task[1]) for task in tasks)):
+        if n_jobs == 1:
+            for task in tasks:
+                _write_chunk(task)
+        elif tasks:
+            with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                list(pool.map(_write_chunk, tasks))
+    return files
@@ -1,5 +1,20 @@
+from __future__ import annotations
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from lib.indicators import PPP, get_store
+from lib.partitions import PartitionedDataset, write_partition
+from lib.profiling import profiled, set_rows
+from lib.survey_cache import DEFAULT_PATH as DEFAULT_CACHE, read_table
+
+import hashlib
+import json
+import numpy as np
+import os
 import pandas as pd
-import world_bank_data as wb
+import re
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+MANIFEST_FILE = "_manifest.json"
 
 
 class LSMS:
@@ -39,7 +54,7 @@ class LSMS:
             self.read_data()
 
     def load_ppp(self) -> float:
-        """Load the [Purchasing Power Parity](https://en.wikipedia.org/wiki/Purchasing_power_parity) of the specified country and year. 
+        """Load the [Purchasing Power Parity](https://en.wikipedia.org/wiki/Purchasing_power_parity) of the specified country and year from the shared indicator cache (see `lib/indicators.py`), which only asks the World Bank on a miss.
 
         Returns:
             float: The PPP of the country at year.
@@ -47,30 +62,27 @@ class LSMS:
         Raises:
             ValueError: If the value is not founded it raises an ValueError. Please look up the [value](https://data.worldbank.org/indicator/PA.NUS.PRVT.PP) here manually. 
         """
-        ppp: float = wb.get_series(
-            "PA.NUS.PRVT.PP", country=self.country_iso, date=self.year)[0]
+        ppp: float = get_store().get(PPP, self.country_iso, self.year)
 
         if ppp == None:
             raise ValueError(
                 f"ppp not found! Please look up the value manually here: https://data.worldbank.org/indicator/PA.NUS.PRVT.PP?locations={self.country_iso}")
         return ppp
 
-    def read_data(self) -> None:
-        """Read the cons. and geovar. file.
-        """
-        if self.cons_path.split(".")[-1].lower() == "csv":
-            cons_reader = pd.read_csv
-        else:
-            cons_reader = pd.read_spss
-
-        if self.hh_path.split(".")[-1].lower() == "csv":
-            hh_reader = pd.read_csv
-        else:
-            hh_reader = pd.read_spss
+    @profiled()
+    def read_data(self, cons_columns: list = None, hh_columns: list = None, cache_dir: str | None = DEFAULT_CACHE) -> None:
+        """Read the cons. and geovar. file. By default the files are read through the columnar cache (see `lib/survey_cache.py`), which parses every raw file only once.
 
-        self.df_cons = cons_reader(self.cons_path, )
-        self.df_hh = hh_reader(self.hh_path)
+        Args:
+            cons_columns (list): columns of the cons. file to read, all if None
+            hh_columns (list): columns of the geovar. file to read, all if None
+            cache_dir (str): directory of the cache, None reads the raw files directly
+        """
+        self.df_cons = read_table(self.cons_path, cons_columns, cache_dir)
+        self.df_hh = read_table(self.hh_path, hh_columns, cache_dir)
+        set_rows(len(self.df_cons) + len(self.df_hh))
 
+    @profiled()
     def process_survey(self, cons_key: str, hhsize_key: str, lat_key: str, lon_key: str, hhid_key: str = "hhid", rural_key: str = "rural", rural_tag: str = "", urban_tag: str = "", multiply: bool = True) -> None:
         """ Processes the surveys, to aggregate the average per capita consumption for each cluster and adjusted according to the PPP.
 
@@ -84,68 +96,46 @@ class LSMS:
             rural_tag (str): key for areas which are rural
             urban_tag (str): key for areas which are urban
         """
-        # code explains well what we are doing here
-        df_cons: pd.DataFrame = self.df_cons.copy()
-        if multiply:
-            df_cons["_cons_ph_"] = df_cons[cons_key] * df_cons[hhsize_key]
-        else:
-            df_cons["_cons_ph_"] = df_cons[cons_key]
-            
-        df_cons["_pph_"] = self.df_cons[hhsize_key]
-        df_cons["_cons_ph_"] = df_cons["_cons_ph_"] / self.ppp / 365
-        df_cons = df_cons[[hhid_key, "_cons_ph_", "_pph_", rural_key]]
+        df_cons: pd.DataFrame = self.df_cons[list(dict.fromkeys([hhid_key, cons_key, hhsize_key, rural_key]))]
+        cons_ph = df_cons[cons_key] * df_cons[hhsize_key] if multiply else df_cons[cons_key]
+        df_cons = pd.DataFrame({
+            hhid_key: df_cons[hhid_key],
+            "_cons_ph_": cons_ph / self.ppp / 365,
+            "_pph_": df_cons[hhsize_key],
+            "_rural_": df_cons[rural_key],
+        })
 
         df_cords: pd.DataFrame = self.df_hh[[hhid_key, lat_key, lon_key]]
         df_cords = df_cords.rename(columns={lat_key: 'lat', lon_key: 'lon'})
 
         tmp_processed: pd.DataFrame = pd.merge(df_cons, df_cords, on=hhid_key)
-        tmp_processed.dropna(inplace=True)  # can't use na values
-
-        rural = tmp_processed[["lat", "lon", rural_key]
-                              ].drop_duplicates().dropna()
-        rural[rural_key] = rural[rural_key].to_list()
-
-        if urban_tag == "":
-            urban_tag = "urban"
-
-        if "," in urban_tag:
-            for tag in urban_tag.split(","):
-                rural.loc[rural[rural_key].astype(str).str.contains(
-                    tag, case=False), rural_key] = "urban"
-        else:
-            rural.loc[rural[rural_key].astype(str).str.contains(
-                urban_tag, case=False), rural_key] = "urban"
-
-        if rural_tag == "":
-            rural_tag = "rural"
-
-        if "," in rural_tag:
-            for tag in rural_tag.split(","):
-                rural.loc[rural[rural_key].astype(str).str.contains(
-                    tag, case=False), rural_key] = "rural"
-        else:
-            rural.loc[rural[rural_key].astype(str).str.contains(
-                rural_tag, case=False), rural_key] = "rural"
-
-        self.processed = tmp_processed.groupby(
-            ["lat", "lon"]).sum().reset_index()
-        
-        self.processed["_cons_pc_"] = self.processed["_cons_ph_"] / \
-            self.processed["_pph_"]  # divides total cluster income by people
-        self.processed["country"] = self.country_iso
-        self.processed["year"] = self.year
-
-        # self.processed["id"] = self.processed[hhid_key]
-        self.processed = self.processed[[
-            "country", "year", "lat", "lon", "_cons_pc_"]]
-
-        self.processed["id"] = [
-            f"{self.country_iso}_{self.year}_{i}" for i in range(len(self.processed))]
-
-        self.processed = self.processed.merge(rural, on=["lat", "lon"])
-
-        self.processed = self.processed.rename(
-            columns={"_cons_pc_": "cons_pc", rural_key: "rural"})
+        tmp_processed = tmp_processed.dropna()  # can't use na values
+
+        # clusters are numbered in the sorted (lat, lon) order of the groupby, the sums only cover the needed columns
+        clusters = tmp_processed.groupby(["lat", "lon"])
+        cluster_id = clusters.ngroup().to_numpy()
+        sums = clusters[["_cons_ph_", "_pph_"]].sum()
+
+        # one row per cluster and distinct raw rural value (in order of appearance), mapped to urban/rural
+        rural_codes, rural_values = pd.factorize(tmp_processed["_rural_"])
+        pairs = cluster_id.astype("int64") * max(len(rural_values), 1) + rural_codes
+        first = np.sort(np.unique(pairs, return_index=True)[1])
+        first = first[np.argsort(cluster_id[first], kind="stable")]
+        rural = _tag_values(rural_values, urban_tag, rural_tag)
+
+        ids = pd.Series(np.arange(len(sums))).astype(str)
+        processed = pd.DataFrame({
+            "country": self.country_iso,
+            "year": self.year,
+            "lat": sums.index.get_level_values("lat"),
+            "lon": sums.index.get_level_values("lon"),
+            "cons_pc": (sums["_cons_ph_"] / sums["_pph_"]).to_numpy(),  # divides total cluster income by people
+            "id": (f"{self.country_iso}_{self.year}_" + ids).to_numpy(),
+        })
+        processed = processed.take(cluster_id[first]).reset_index(drop=True)
+        processed["rural"] = pd.Series(rural[rural_codes[first]]).infer_objects()
+        self.processed = processed
+        set_rows(len(tmp_processed))
 
     def write_processed(self, path: str) -> None:
         """Writes the processed file into the given path.
@@ -154,3 +144,178 @@ class LSMS:
             path (str): Path for writing the file
         """
         self.processed.to_csv(path, index=False)
+
+
+def _tag_pattern(tags: str, default: str) -> re.Pattern:
+    """Compile the comma separated tags of `country_keys.json` into one case insensitive pattern, matching like `str.contains` does for each tag.
+
+    Args:
+        tags (str): comma separated regular expressions, `default` if empty
+        default (str): tag used if none is given
+
+    Returns:
+        re.Pattern: compiled pattern
+    """
+    tags = tags if tags != "" else default
+    return re.compile("|".join(f"(?:{tag})" for tag in tags.split(",")), re.IGNORECASE)
+
+
+def _tag_values(values, urban_tag: str, rural_tag: str) -> np.ndarray:
+    """Map distinct raw values of the rural column to `urban` or `rural`. Values matching an urban tag become `urban` first, then everything matching a rural tag becomes `rural`, other values are kept.
+
+    Args:
+        values: distinct raw values
+        urban_tag (str): tags for areas which are urban
+        rural_tag (str): tags for areas which are rural
+
+    Returns:
+        np.ndarray: mapped values (object)
+    """
+    urban = _tag_pattern(urban_tag, "urban")
+    rural = _tag_pattern(rural_tag, "rural")
+    mapped = np.empty(len(values), dtype=object)
+    for i, value in enumerate(values):
+        value = "urban" if urban.search(str(value)) else value
+        mapped[i] = "rural" if rural.search(str(value)) else value
+    return mapped
+
+
+def file_hash(path: str) -> str:
+    """SHA-256 of the content of a file.
+
+    Args:
+        path (str): file
+
+    Returns:
+        str: hex digest
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def survey_hash(entry: dict, ppp: float, root: str = REPO_ROOT) -> str:
+    """Hash of everything a processed survey depends on: the config entry, the PPP and the content of the input files.
+
+    Args:
+        entry (dict): entry of `country_keys.json`
+        ppp (float): PPP used for the survey
+        root (str): directory the paths of the entry are relative to
+
+    Returns:
+        str: hex digest
+    """
+    digest = hashlib.sha256(json.dumps(entry, sort_keys=True).encode())
+    digest.update(repr(float(ppp)).encode())
+    for key in ["cons_path", "hh_path", "cluster_path"]:
+        if key in entry:
+            digest.update(file_hash(os.path.join(root, entry[key])).encode())
+    return digest.hexdigest()
+
+
+@profiled(rows=len)
+def process_entry(country: str, year: str, entry: dict, ppp: float, root: str = REPO_ROOT, cache_dir: str | None = DEFAULT_CACHE) -> pd.DataFrame:
+    """Process one survey of `country_keys.json`. Special entries with a `cluster_path` (Tanzania 2014) link the households to the cluster coordinates through that file. Only the columns named in the entry are read.
+
+    Args:
+        country (str): ISO code of the country
+        year (str): year of the survey
+        entry (dict): entry of `country_keys.json`
+        ppp (float): PPP, 1 for nominal consumption
+        root (str): directory the paths of the entry are relative to
+        cache_dir (str): directory of the columnar cache, None reads the raw files directly
+
+    Returns:
+        pd.DataFrame: processed survey
+    """
+    lsms = LSMS(country, year, cons_path=os.path.join(root, entry["cons_path"]), hh_path=os.path.join(root, entry["hh_path"]), ppp=ppp)
+    cons_columns = list(dict.fromkeys([entry["hhid_key"], entry["cons_key"], entry["hhsize_key"], entry["rural_key"]]))
+    cords_columns = [entry["lat_key"], entry["lon_key"]]
+    if entry["special"] and "cluster_path" in entry:
+        lsms.read_data(cons_columns, [entry["hhid_key"], "clusterid"], cache_dir)
+        clusters = read_table(os.path.join(root, entry["cluster_path"]), ["clusterid"] + cords_columns, cache_dir)
+        lsms.df_hh = lsms.df_hh.merge(clusters, on=["clusterid"])
+    else:
+        lsms.read_data(cons_columns, [entry["hhid_key"]] + cords_columns, cache_dir)
+    lsms.process_survey(cons_key=entry["cons_key"], hhsize_key=entry["hhsize_key"], lat_key=entry["lat_key"], lon_key=entry["lon_key"], hhid_key=entry["hhid_key"],
+                        rural_key=entry["rural_key"], rural_tag=entry["rural"], urban_tag=entry["urban"], multiply=entry["multiply"])
+    return lsms.processed
+
+
+def _process_job(args) -> tuple:
+    country, year, entry, ppp, root, cache_dir = args
+    return country, year, process_entry(country, year, entry, ppp, root, cache_dir)
+
+
+@profiled(rows=len)
+def run_surveys(config_path: str, out_path: str, nominal: bool = True, n_jobs: int = 1, root: str = REPO_ROOT, force: bool = False,
+                cache_dir: str | None = DEFAULT_CACHE, combined_csv: bool = True) -> pd.DataFrame:
+    """Process all surveys of `country_keys.json` and write `{country}_{year}_{nominal|real}.csv` for each survey, its partition of the dataset `_all_{nominal|real}` (see `lib/partitions.py`) and optionally `_all_{nominal|real}.csv` with all of them. Surveys whose inputs, config entry and PPP are unchanged since the last run (see `_manifest.json` in `out_path`) are not processed again.
+
+    Args:
+        config_path (str): path of `country_keys.json`
+        out_path (str): directory of the processed files
+        nominal (bool): nominal consumption if `True`, otherwise adjusted by the PPP
+        n_jobs (int): number of processes, 1 processes in this process
+        root (str): directory the paths in the config are relative to (the repository)
+        force (bool): process all surveys, even unchanged ones
+        cache_dir (str): directory of the columnar cache, None reads the raw files directly
+        combined_csv (bool): also write `_all_{nominal|real}.csv`
+
+    Returns:
+        pd.DataFrame: all processed surveys in the order of the config
+    """
+    with open(config_path, "r") as f:
+        data = json.load(f)
+    ending = "nominal" if nominal else "real"
+    manifest_path = os.path.join(out_path, MANIFEST_FILE)
+    dataset_path = os.path.join(out_path, f"_all_{ending}")
+    manifest = {}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+
+    jobs, hashes = [], {}
+    for country in data:
+        for year in data[country]:
+            name = f"{country}_{year}_{ending}"
+            ppp = 1 if nominal else LSMS(country, year).ppp
+            hashes[name] = survey_hash(data[country][year], ppp, root)
+            if force or manifest.get(name) != hashes[name] or not os.path.isfile(os.path.join(out_path, name + ".csv")):
+                jobs.append((country, year, data[country][year], ppp, root, cache_dir))
+
+    def done(country: str, year: str, processed: pd.DataFrame) -> None:
+        # the manifest is updated after every survey, an interrupted run keeps the finished ones
+        name = f"{country}_{year}_{ending}"
+        processed = processed.assign(year=processed["year"].astype(int))  # years are strings in the config
+        processed.to_csv(os.path.join(out_path, name + ".csv"), index=False)
+        write_partition(dataset_path, country, year, processed)
+        manifest[name] = hashes[name]
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=4, sort_keys=True)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+    os.makedirs(out_path, exist_ok=True)
+    if n_jobs == 1:
+        for job in jobs:
+            done(*_process_job(job))
+    elif jobs:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            for future in as_completed([pool.submit(_process_job, job) for job in jobs]):
+                done(*future.result())
+
+    # surveys processed before the partitioned layout existed
+    partitioned = set(PartitionedDataset(dataset_path).surveys())
+    for country in data:
+        for year in data[country]:
+            if (country, int(year)) not in partitioned:
+                processed = pd.read_csv(os.path.join(out_path, f"{country}_{year}_{ending}.csv"), float_precision="round_trip")
+                write_partition(dataset_path, country, year, processed)
+
+    dataset = PartitionedDataset(dataset_path)
+    master_df = pd.concat([dataset.read_survey(country, year) for country in data for year in data[country]], ignore_index=True)
+    if combined_csv:
+        master_df.to_csv(os.path.join(out_path, f"_all_{ending}.csv"), index=False)
+    return master_df
@@ -0,0 +1,329 @@
+"""
+Concurrent client for the OSM features of 2_osm.ipynb, using the ohsome REST API (https://docs.ohsome.org/ohsome-api/v1/).
+
+All requests of a survey (buildings: 5 filters x 3 metrics, roads: 3 totals + 3 grouped by tag, POIs: 1 grouped by tag)
+are split into chunks of bounding boxes and sent through a bounded thread pool. Failed requests (connection errors,
+timeouts, 429 and 5xx) are retried with exponential backoff. The response of every (survey, metric) is checkpointed as
+Parquet, so an interrupted extraction only repeats the missing metrics. The base URL can point to a local stand-in
+server.
+
+The responses have the layout of ohsome-py's as_dataframe(): a "value" column indexed by (boundary, timestamp), or by
+(boundary, tag, timestamp) for requests grouped by tag.
+"""
+from __future__ import annotations
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+import requests
+
+from lib.profiling import profiled
+
+OHSOME_URL = "https://api.ohsome.org/v1"
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+BUILDING_FILTERS = {
+    "building": "building=*",
+    "residential": "residential=* or building=residential or abutters=residential or construction=residential or landuse=residential",
+    "industry": "industry=*",
+    "education": "amenity=school or amenity=kindergarten or amenity=university or amenity=college or landuse=education",
+    "health": "healthcare=* or amenity=doctors or amenity=hospital or amenity=pharmacy",
+}
+AREA_METRICS = {"count": "elements/count", "area": "elements/area", "density": "elements/area/density"}
+LENGTH_METRICS = {"count": "elements/count", "length": "elements/length", "density": "elements/length/density"}
+ROAD_FILTER = "highway=* and type:way"
+POI_FILTER = "amenity=*"
+
+# tag values and column order of _all_pois.csv and _all_road.csv
+POI_TYPES = [
+    "library", "hostel", "car_rental", "shelter", "furniture_shop", "water_works", "bar", "post_box", "tourist_info", "pub",
+    "laundry", "water_tower", "tower", "community_centre", "nightclub", "college", "cafe", "bench", "gift_shop",
+    "mobile_phone_shop", "hotel", "pharmacy", "bank", "fast_food", "car_dealership", "computer_shop", "bakery", "toilet",
+    "clothes", "park", "department_store", "supermarket", "chalet", "memorial", "prison", "cinema", "travel_agent", "track",
+    "waste_basket", "guesthouse", "school", "monument", "graveyard", "motel", "university", "greengrocer", "mall",
+    "playground", "chemist", "police", "telephone", "picnic_site", "public_building", "doityourself", "restaurant",
+    "fire_station", "comms_tower", "convenience", "viewpoint", "butcher", "optician", "theatre", "drinking_water", "museum",
+    "bookshop", "camp_site", "courthouse", "veterinary", "water_well", "bicycle_shop", "outdoor_shop", "camera_surveillance",
+    "atm", "sports_shop", "recycling", "embassy", "stationery", "sports_centre", "hospital", "attraction", "doctors",
+    "dentist", "kindergarten", "florist", "artwork", "jeweller", "swimming_pool", "fountain", "stadium", "food_court",
+    "hairdresser", "car_wash", "post_office", "beauty_shop", "beverages", "town_hall", "others", "pitch", "toy_shop",
+    "kiosk", "shoe_shop",
+]
+ROAD_TYPES = ["trunk", "residential", "pedestrian", "service", "primary", "intersection", "secondary", "living_street", "track", "tertiary"]
+
+
+@dataclass(frozen=True)
+class OsmRequest:
+    """
+    One aggregation of the ohsome API, grouped by boundary and optionally by the values of a tag.
+    """
+    name: str
+    endpoint: str
+    filter: str
+    group_by_key: str = None
+
+    @property
+    def path(self) -> str:
+        return f"{self.endpoint}/groupBy/boundary" + ("/groupBy/tag" if self.group_by_key else "")
+
+
+def building_requests() -> list:
+    """
+    The 15 building requests, named {filter}_{metric} like the columns of _all_buildings.csv.
+    """
+    return [OsmRequest(f"{key}_{metric}", endpoint, filter)
+            for key, filter in BUILDING_FILTERS.items() for metric, endpoint in AREA_METRICS.items()]
+
+
+def poi_requests() -> list:
+    """
+    The amenity counts grouped by tag.
+    """
+    return [OsmRequest("pois", "elements/count", POI_FILTER, "amenity")]
+
+
+def road_requests() -> list:
+    """
+    The road totals (total_{metric}) and the road metrics grouped by highway type ({metric}).
+    """
+    totals = [OsmRequest(f"total_{metric}", endpoint, ROAD_FILTER) for metric, endpoint in LENGTH_METRICS.items()]
+    grouped = [OsmRequest(metric, endpoint, ROAD_FILTER, "highway") for metric, endpoint in LENGTH_METRICS.items()]
+    return totals + grouped
+
+
+def parse_response(data: dict, grouped: bool) -> pd.DataFrame:
+    """
+    Convert the JSON of a groupBy/boundary(/groupBy/tag) response into a frame.
+
+    Args:
+    - data (dict): JSON response
+    - grouped (bool): Response is grouped by tag
+
+    Return:
+    - pd.Dataframe: "value" indexed by (boundary, [tag,] timestamp)
+    """
+    boundaries, tags, timestamps, values = [], [], [], []
+    for group in data["groupByResult"]:
+        key = group["groupByObject"]
+        for result in group["result"]:
+            boundaries.append(key[0] if grouped else key)
+            if grouped:
+                tags.append(key[1])
+            timestamps.append(result["timestamp"])
+            values.append(result["value"])
+
+    arrays = [boundaries, tags, pd.to_datetime(timestamps)] if grouped else [boundaries, pd.to_datetime(timestamps)]
+    names = ["boundary", "tag", "timestamp"] if grouped else ["boundary", "timestamp"]
+    return pd.DataFrame({"value": pd.Series(values, dtype="float64").to_numpy()}, index=pd.MultiIndex.from_arrays(arrays, names=names))
+
+
+def format_bboxes(bboxes: dict) -> str:
+    """
+    Format {id: [minx, miny, maxx, maxy]} as the bboxes parameter of the API.
+    """
+    return "|".join(f"{key}:" + ",".join(str(v) for v in bbox) for key, bbox in bboxes.items())
+
+
+class OsmClient:
+
+    def __init__(self, base_url: str = OHSOME_URL, max_workers: int = 4, chunk_size: int = 500, retries: int = 5,
+                 backoff: float = 2.0, timeout: float = 600) -> None:
+        """
+        Client for the ohsome API.
+
+        Args:
+        - base_url (str): URL of the API, e.g. of a local stand-in server
+        - max_workers (int): Maximal number of concurrent requests
+        - chunk_size (int): Maximal number of bounding boxes per request
+        - retries (int): Number of retries of a failed request
+        - backoff (float): Wait before the first retry in seconds, doubled for every further retry
+        - timeout (float): Timeout of a request in seconds
+        """
+        self.base_url = base_url.rstrip("/")
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _session(self) -> requests.Session:
+        # one session per thread, the pool reuses the connections
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def post(self, path: str, data: dict) -> dict:
+        """
+        POST to the API, with retries for transient errors.
+
+        Args:
+        - path (str): Endpoint, e.g. elements/count/groupBy/boundary
+        - data (dict): Form parameters
+
+        Return:
+        - dict: JSON response
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                response = self._session().post(f"{self.base_url}/{path}", data=data, timeout=self.timeout)
+                if response.status_code not in RETRY_STATUS:
+                    response.raise_for_status()
+                    return response.json()
+                error = requests.HTTPError(f"{response.status_code} for {path}", response=response)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            if attempt < self.retries:
+                time.sleep(self.backoff * 2**attempt)
+        raise error
+
+    @profiled(rows=len)
+    def _fetch_chunk(self, request: OsmRequest, bboxes: dict, timestamp: str) -> pd.DataFrame:
+        data = {"bboxes": format_bboxes(bboxes), "time": timestamp, "filter": request.filter, "format": "json"}
+        if request.group_by_key:
+            data["groupByKey"] = request.group_by_key
+        return parse_response(self.post(request.path, data), request.group_by_key is not None)
+
+    @profiled()
+    def fetch_all(self, osm_requests: list, bboxes: dict, timestamp: str, checkpoint_dir: str = None) -> dict:
+        """
+        Run the requests for all bounding boxes. The chunks of all requests share the pool. If a request fails, the
+        other requests are still finished and checkpointed before the error is raised.
+
+        Args:
+        - osm_requests (list): OsmRequest
+        - bboxes (dict): id -> [minx, miny, maxx, maxy]
+        - timestamp (str): Time of the OSM history, e.g. 2015-12-31
+        - checkpoint_dir (str): Directory for the finished responses ({name}.parquet), which are not requested again
+
+        Return:
+        - dict: name of the request -> response frame
+        """
+        results, pending = {}, []
+        for request in osm_requests:
+            path = os.path.join(checkpoint_dir, f"{request.name}.parquet") if checkpoint_dir else None
+            if path and os.path.isfile(path):
+                results[request.name] = pd.read_parquet(path)
+            else:
+                pending.append((request, path))
+        if not pending:
+            return results
+
+        keys = list(bboxes)
+        chunks = [{key: bboxes[key] for key in keys[i:i + self.chunk_size]} for i in range(0, len(keys), self.chunk_size)]
+        if checkpoint_dir:
+            os.makedirs(checkpoint_dir, exist_ok=True)
+
+        error = None
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = [(request, path, [pool.submit(self._fetch_chunk, request, chunk, timestamp) for chunk in chunks])
+                       for request, path in pending]
+            for request, path, chunk_futures in futures:
+                try:
+                    response = pd.concat([future.result() for future in chunk_futures])
+                except Exception as e:
+                    error = error or e
+                    continue
+                if path:
+                    response.to_parquet(path + ".tmp")
+                    os.replace(path + ".tmp", path)
+                results[request.name] = response
+        if error is not None:
+            raise error
+        return {request.name: results[request.name] for request in osm_requests}
+
+    def fetch(self, request: OsmRequest, bboxes: dict, timestamp: str, checkpoint_dir: str = None) -> pd.DataFrame:
+        """
+        Run one request for all bounding boxes, see fetch_all.
+        """
+        return self.fetch_all([request], bboxes, timestamp, checkpoint_dir)[request.name]
+
+
+def boundary_values(response: pd.DataFrame) -> pd.Series:
+    """
+    Values of a response grouped by boundary, indexed by the boundary (first timestamp only).
+    """
+    values = response["value"]
+    values = values[~values.index.get_level_values("boundary").duplicated()]
+    return pd.Series(values.to_numpy(), index=values.index.get_level_values("boundary"))
+
+
+def tag_matrix(response: pd.DataFrame, key: str, names: list) -> pd.DataFrame:
+    """
+    Pivot a response grouped by boundary and tag into a dense matrix. The tag values are normalized like in
+    2_osm.ipynb (without "{key}=", spaces to underscores, lower case); values outside of names are dropped and
+    missing ones are 0. Tags that do not occur at all are int columns, as in the CSV files.
+
+    Args:
+    - response (pd.Dataframe): Response of OsmClient grouped by tag
+    - key (str): Tag key, e.g. amenity
+    - names (list): Tag values in column order
+
+    Return:
+    - pd.Dataframe: shape (boundaries in order of the response, names)
+    """
+    index = response.index
+    boundaries = index.get_level_values("boundary")
+    tag_codes, tags = pd.factorize(index.get_level_values("tag"))
+    tags = pd.Index(tags).str.replace(f"{key}=", "", regex=False).str.replace(" ", "_", regex=False).str.lower()
+    frame = pd.DataFrame({"boundary": boundaries, "tag": tags.take(tag_codes), "value": response["value"].to_numpy()})
+    frame = frame[frame.tag.isin(names)].drop_duplicates(["boundary", "tag"])
+
+    matrix = frame.pivot(index="boundary", columns="tag", values="value")
+    matrix = matrix.reindex(index=pd.unique(boundaries)).fillna(0)
+    zeros = np.zeros(len(matrix), dtype="int64")
+    return pd.DataFrame({name: matrix[name].to_numpy() if name in matrix.columns else zeros for name in names}, index=matrix.index)
+
+
+@profiled(rows=len)
+def buildings_frame(responses: dict) -> pd.DataFrame:
+    """
+    Building features of a survey with the columns of _all_buildings.csv.
+
+    Args:
+    - responses (dict): Responses of building_requests()
+
+    Return:
+    - pd.Dataframe
+    """
+    names = [request.name for request in building_requests()]
+    frame = pd.concat([boundary_values(responses[name]).rename(name) for name in names], axis=1, join="inner")
+    return frame.rename_axis("id").reset_index()
+
+
+@profiled(rows=len)
+def pois_frame(response: pd.DataFrame) -> pd.DataFrame:
+    """
+    POI counts of a survey with the columns of _all_pois.csv.
+
+    Args:
+    - response (pd.Dataframe): Response of poi_requests()
+
+    Return:
+    - pd.Dataframe
+    """
+    matrix = tag_matrix(response, "amenity", POI_TYPES)
+    return pd.concat([matrix.reset_index(drop=True), pd.Series(matrix.index, name="id")], axis=1)
+
+
+@profiled(rows=len)
+def road_frame(responses: dict) -> pd.DataFrame:
+    """
+    Road features of a survey with the columns of _all_road.csv.
+
+    Args:
+    - responses (dict): Responses of road_requests()
+
+    Return:
+    - pd.Dataframe
+    """
+    parts = [boundary_values(responses[f"total_{metric}"]).rename(f"total_{metric}") for metric in LENGTH_METRICS]
+    for metric in LENGTH_METRICS:
+        matrix = tag_matrix(responses[metric], "highway", ROAD_TYPES)
+        parts.append(matrix.set_axis([f"{metric}_{name}" for name in ROAD_TYPES], axis=1))
+    return pd.concat(parts, axis=1, join="inner").rename_axis("id").reset_index()
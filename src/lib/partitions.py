@@ -0,0 +1,179 @@
+"""
+Partitioned layout for the combined datasets (_all_nominal, _all_real, _all_buildings, _all_pois, _all_road).
+
+A dataset is a directory with one Parquet file per survey ({country}_{year}.parquet) and a manifest.json listing the
+partitions in order with their country, year and number of rows. Adding or replacing a survey only writes its own
+partition and the manifest. PartitionedDataset presents the union of the partitions and reads only the partitions
+(and columns) which are requested.
+"""
+from __future__ import annotations
+
+import json
+import os
+
+import pandas as pd
+
+MANIFEST_FILE = "manifest.json"
+PARTITION_FILE = "{country}_{year}.parquet"
+
+
+def is_partitioned(path: str) -> bool:
+    """
+    Check if path is a partitioned dataset.
+    """
+    return os.path.isfile(os.path.join(path, MANIFEST_FILE))
+
+
+def survey_keys(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Country and year of every row, from the country and year columns or else from the id ({country}_{year}_{i}).
+
+    Args:
+    - df (pd.Dataframe): Survey or OSM data
+
+    Return:
+    - pd.Dataframe: columns country and year (int)
+    """
+    if "country" in df.columns and "year" in df.columns:
+        return pd.DataFrame({"country": df["country"].astype(str), "year": df["year"].astype(int)}, index=df.index)
+    parts = df["id"].astype(str).str.split("_", n=2, expand=True)
+    return pd.DataFrame({"country": parts[0], "year": parts[1].astype(int)}, index=df.index)
+
+
+def _read_manifest(path: str) -> dict:
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    if not os.path.isfile(manifest_path):
+        return {"partitions": []}
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+
+def _write_manifest(path: str, manifest: dict) -> None:
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def write_partition(path: str, country: str, year: int, df: pd.DataFrame) -> None:
+    """
+    Write or replace the partition of one survey. A new partition is appended to the end of the dataset, a replaced
+    one keeps its position.
+
+    Args:
+    - path (str): Dataset directory
+    - country (str): Country of the survey
+    - year (int): Year of the survey
+    - df (pd.Dataframe): Data of the survey
+    """
+    os.makedirs(path, exist_ok=True)
+    # columns with mixed types (e.g. unmapped rural codes next to "urban") are stored as strings, as a CSV would read them
+    mixed = [col for col in df.columns if df[col].dtype == object and pd.api.types.infer_dtype(df[col], skipna=True).startswith("mixed")]
+    if mixed:
+        df = df.assign(**{col: df[col].where(df[col].isna(), df[col].astype(str)) for col in mixed})
+    file = PARTITION_FILE.format(country=country, year=int(year))
+    df.to_parquet(os.path.join(path, file + ".tmp"), index=False)
+    os.replace(os.path.join(path, file + ".tmp"), os.path.join(path, file))
+
+    manifest = _read_manifest(path)
+    entry = {"country": country, "year": int(year), "file": file, "rows": len(df)}
+    files = [partition["file"] for partition in manifest["partitions"]]
+    if file in files:
+        manifest["partitions"][files.index(file)] = entry
+    else:
+        manifest["partitions"].append(entry)
+    _write_manifest(path, manifest)
+
+
+def write_dataset(path: str, df: pd.DataFrame) -> None:
+    """
+    Split a combined frame (e.g. an existing _all_*.csv) into the partitions of its surveys.
+
+    Args:
+    - path (str): Dataset directory
+    - df (pd.Dataframe): Combined data
+    """
+    keys = survey_keys(df)
+    for (country, year), rows in df.groupby([keys.country, keys.year], sort=False).groups.items():
+        write_partition(path, country, year, df.loc[rows].reset_index(drop=True))
+
+
+class PartitionedDataset:
+
+    def __init__(self, path: str) -> None:
+        """
+        Lazy union of the partitions of a dataset.
+
+        Args:
+        - path (str): Dataset directory
+        """
+        self.path = path
+        self.partitions = _read_manifest(path)["partitions"]
+
+    def __len__(self) -> int:
+        return sum(partition["rows"] for partition in self.partitions)
+
+    def surveys(self) -> list:
+        """
+        Return:
+        - list: (country, year) of all partitions in order
+        """
+        return [(partition["country"], partition["year"]) for partition in self.partitions]
+
+    def select(self, countries: list = None, years: list = None) -> list:
+        """
+        Partitions of the given countries and years (all if None).
+        """
+        return [partition for partition in self.partitions
+                if (countries is None or partition["country"] in countries) and (years is None or partition["year"] in years)]
+
+    def read(self, countries: list = None, years: list = None, columns: list = None) -> pd.DataFrame:
+        """
+        Read the selected partitions into one frame, in the order of the dataset.
+
+        Args:
+        - countries (list): Countries to read, all if None
+        - years (list): Years to read, all if None
+        - columns (list): Columns to read, all if None
+
+        Return:
+        - pd.Dataframe
+        """
+        years = None if years is None else [int(year) for year in years]
+        frames = [pd.read_parquet(os.path.join(self.path, partition["file"]), columns=columns)
+                  for partition in self.select(countries, years)]
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(frames, ignore_index=True)
+
+    def read_survey(self, country: str, year: int, columns: list = None) -> pd.DataFrame:
+        """
+        Read the partition of one survey.
+        """
+        return pd.read_parquet(os.path.join(self.path, PARTITION_FILE.format(country=country, year=int(year))), columns=columns)
+
+
+def read_combined(path: str, countries: list = None, years: list = None) -> pd.DataFrame:
+    """
+    Read a combined dataset, either partitioned or as CSV, restricted to the given countries and years (all if None).
+
+    Args:
+    - path (str): Dataset directory or CSV file
+    - countries (list): Countries to read, all if None
+    - years (list): Years to read, all if None
+
+    Return:
+    - pd.Dataframe
+    """
+    if is_partitioned(path):
+        return PartitionedDataset(path).read(countries, years)
+    df = pd.read_csv(path)
+    if countries is None and years is None:
+        return df
+    keys = survey_keys(df)
+    mask = pd.Series(True, index=df.index)
+    if countries is not None:
+        mask &= keys.country.isin(countries)
+    if years is not None:
+        mask &= keys.year.isin([int(year) for year in years])
+    return df[mask].reset_index(drop=True)
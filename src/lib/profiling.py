@@ -0,0 +1,275 @@
+"""
+Opt-in timing instrumentation of the pipeline.
+
+The library functions open named spans (context manager span, decorator profiled, generator iterate). While
+profiling is disabled, which is the default, a span only costs a function call. Once enabled (enable() or the
+environment variable POVERTY_PROFILE=1) every span records its wall time, the number of rows it processed, the peak
+resident memory of the process at its end and how much the span raised that peak. Spans nest per thread, so a report
+shows e.g. which part of get_data is reading, parsing or joining.
+
+Spans opened in worker processes (n_jobs > 1) are not collected, only the span around the pool.
+
+Usage:
+    profiling.enable()
+    complete, osm_cols = get_data(...)
+    profiling.write_report("profile.json")  # or .csv
+    profiling.compare_reports("before.json", "profile.json")
+"""
+from __future__ import annotations
+
+import contextlib
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from dataclasses import asdict, dataclass
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+ENV_VAR = "POVERTY_PROFILE"
+
+_enabled = os.environ.get(ENV_VAR, "") not in ("", "0")
+_origin = time.perf_counter()
+_spans = []
+_lock = threading.Lock()
+_local = threading.local()
+
+
+@dataclass
+class Span:
+    name: str
+    parent: str | None = None
+    depth: int = 0
+    start_s: float = 0.0
+    wall_s: float = 0.0
+    rows: int | None = None
+    peak_rss_mb: float | None = None
+    peak_rss_growth_mb: float | None = None
+    thread: str = ""
+
+
+def peak_rss_mb() -> float | None:
+    """
+    Return:
+    - float: peak resident memory of the process in MB, None if it is not available
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes everywhere else
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def enable(clear: bool = True) -> None:
+    """
+    Start recording spans, by default discarding the spans recorded so far.
+    """
+    global _enabled
+    if clear:
+        reset()
+    _enabled = True
+
+
+def disable() -> None:
+    """
+    Stop recording spans, the recorded ones are kept.
+    """
+    global _enabled
+    _enabled = False
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def reset() -> None:
+    """
+    Discard the recorded spans.
+    """
+    global _origin
+    with _lock:
+        _spans.clear()
+        _origin = time.perf_counter()
+
+
+@contextlib.contextmanager
+def span(name: str, rows: int | None = None):
+    """
+    Record the block as a span. The yielded Span can be used to set the rows once they are known.
+
+    Args:
+    - name (str): Name of the span, e.g. "get_data.merge"
+    - rows (int): Number of rows processed, if already known
+    """
+    record = Span(name, rows=rows)
+    if not _enabled:
+        yield record
+        return
+
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    record.parent = stack[-1].name if stack else None
+    record.depth = len(stack)
+    record.thread = threading.current_thread().name
+    peak_before = peak_rss_mb()
+    stack.append(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        end = time.perf_counter()
+        stack.pop()
+        record.start_s = start - _origin
+        record.wall_s = end - start
+        record.peak_rss_mb = peak_rss_mb()
+        if peak_before is not None:
+            record.peak_rss_growth_mb = record.peak_rss_mb - peak_before
+        with _lock:
+            _spans.append(record)
+
+
+def set_rows(rows: int) -> None:
+    """
+    Set the rows of the innermost open span of this thread, e.g. at the end of a function decorated with profiled.
+    """
+    stack = getattr(_local, "stack", None)
+    if _enabled and stack:
+        stack[-1].rows = int(rows)
+
+
+def profiled(name: str | None = None, rows=None):
+    """
+    Decorator recording every call of the function as a span.
+
+    Args:
+    - name (str): Name of the span, the qualified name of the function if None
+    - rows (callable): Computes the rows from the return value, e.g. lambda result: len(result), otherwise the
+      function can call set_rows
+    """
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with span(span_name) as record:
+                result = func(*args, **kwargs)
+                if rows is not None:
+                    record.rows = int(rows(result))
+                return result
+        return wrapper
+    return decorator
+
+
+def iterate(iterable, name: str, rows=None):
+    """
+    Iterate and record the whole iteration as one span, e.g. over a tf.data.Dataset.
+
+    Args:
+    - iterable: Elements to yield
+    - name (str): Name of the span
+    - rows (callable): Rows of an element (e.g. the batch size), every element counts as one row if None
+    """
+    if not _enabled:
+        yield from iterable
+        return
+    with span(name, rows=0) as record:
+        for element in iterable:
+            record.rows += 1 if rows is None else int(rows(element))
+            yield element
+
+
+def spans() -> pd.DataFrame:
+    """
+    Return:
+    - pd.Dataframe: one row per recorded span, ordered by start time
+    """
+    with _lock:
+        records = [asdict(record) for record in _spans]
+    columns = list(Span.__dataclass_fields__)
+    return pd.DataFrame(records, columns=columns).sort_values("start_s", kind="stable").reset_index(drop=True)
+
+
+def summary(table: pd.DataFrame | None = None) -> pd.DataFrame:
+    """
+    Aggregate the spans by name.
+
+    Args:
+    - table (pd.Dataframe): Spans as returned by spans(), the recorded ones if None
+
+    Return:
+    - pd.Dataframe: calls, total/mean/max wall time, rows, rows per second and peak memory per name
+    """
+    table = spans() if table is None else table
+    grouped = table.groupby("name", sort=False)
+    result = pd.DataFrame({
+        "calls": grouped.size(),
+        "total_s": grouped.wall_s.sum(),
+        "mean_s": grouped.wall_s.mean(),
+        "max_s": grouped.wall_s.max(),
+        "rows": grouped.rows.sum(min_count=1),
+        "peak_rss_mb": grouped.peak_rss_mb.max(),
+        "peak_rss_growth_mb": grouped.peak_rss_growth_mb.sum(min_count=1),
+    })
+    result["rows_per_s"] = result.rows / result.total_s
+    return result.reset_index()
+
+
+def write_report(path: str, metadata: dict | None = None) -> None:
+    """
+    Write the recorded spans, as CSV (one row per span) or JSON (spans, summary and metadata) by file extension.
+
+    Args:
+    - path (str): Report file, .csv or .json
+    - metadata (dict): Extra information stored in the JSON report, e.g. the dataset or the commit
+    """
+    table = spans()
+    if path.lower().endswith(".csv"):
+        table.to_csv(path, index=False)
+        return
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "metadata": metadata or {},
+        "spans": json.loads(table.to_json(orient="records")),
+        "summary": json.loads(summary(table).to_json(orient="records")),
+    }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=4)
+
+
+def read_report(path: str) -> pd.DataFrame:
+    """
+    Read the spans of a report written by write_report.
+    """
+    if path.lower().endswith(".csv"):
+        return pd.read_csv(path)
+    with open(path, "r") as f:
+        return pd.DataFrame(json.load(f)["spans"])
+
+
+def compare_reports(base_path: str, path: str) -> pd.DataFrame:
+    """
+    Compare two reports by span name.
+
+    Args:
+    - base_path (str): Report of the reference run
+    - path (str): Report of the new run
+
+    Return:
+    - pd.Dataframe: total wall time and peak memory of both runs and the ratio new / reference of the wall time
+    """
+    columns = ["name", "calls", "total_s", "rows", "peak_rss_mb"]
+    base = summary(read_report(base_path))[columns]
+    new = summary(read_report(path))[columns]
+    table = base.merge(new, on="name", how="outer", suffixes=("_base", "_new"))
+    table["ratio"] = table.total_s_new / table.total_s_base
+    return table
@@ -0,0 +1,272 @@
+"""
+Closed-form K-fold ridge regression.
+
+The cross products of the (globally centered) data are computed once per dataset and every fold is derived from them:
+- primal form (more rows than features): the training Gram of a fold is the full Gram minus the Gram of its test rows
+- dual form (fewer rows than features): the training kernel of a fold is a submatrix of the full kernel
+A fold then costs one small symmetric solve instead of a refit over all rows, and a whole grid of alphas costs one
+eigendecomposition per fold. The fold solutions equal sklearn's Ridge(alpha) (fit_intercept=True) fitted on the same
+KFold splits.
+"""
+from __future__ import annotations
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+from scipy import linalg
+from sklearn.linear_model import Ridge
+from sklearn.model_selection import KFold
+
+import numpy as np
+
+
+def pearson_r2(y: np.array, y_pred: np.array) -> np.array:
+    """
+    Squared Pearson correlation between y and every column of y_pred.
+
+    Args:
+    - y (np.array): Ground truth, shape (n,)
+    - y_pred (np.array): Predictions, shape (n,) or (n, k)
+
+    Return:
+    - r^2, scalar for 1-d predictions otherwise shape (k,)
+    """
+    yc = y - y.mean()
+    pc = y_pred - y_pred.mean(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r = (yc @ pc) / (np.sqrt(yc @ yc) * np.sqrt(np.sum(pc**2, axis=0)))
+    return r**2
+
+
+@dataclass
+class Fold:
+    """
+    Sufficient statistics of the training part of a fold, in globally centered coordinates.
+    """
+    train_ind: np.array
+    test_ind: np.array
+    x_mean: np.array  # mean of X_train
+    y_mean: float  # mean of y_train
+    gram: np.array  # primal: centered X_train^T X_train, dual: centered X_train X_train^T
+    rhs: np.array  # primal: centered X_train^T y_train, dual: centered y_train
+
+
+class KFoldRidge:
+
+    def __init__(self, X: np.array, y: np.array, n_splits: int = 10, seed: int = 42) -> None:
+        """
+        Precompute the statistics of all folds.
+
+        Args:
+        - X (np.array): Features
+        - y (np.array): Consumption
+        - n_splits (int): Number of folds
+        - seed (int): For reproducibility, same meaning as in KFold
+        """
+        X = np.asarray(X, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        self.n_features = X.shape[1]
+        self.x_offset = X.mean(axis=0)
+        self.y_offset = y.mean()
+        self.X = X - self.x_offset
+        self.y = y - self.y_offset
+        self.n_splits = n_splits
+        self.seed = seed
+        self._coefs = {}
+
+        splits = list(KFold(n_splits=n_splits, shuffle=True, random_state=seed).split(X, y))
+        self.dual = max(len(train_ind) for train_ind, _ in splits) < self.n_features
+        if self.dual:
+            kernel = self.X @ self.X.T
+            self.folds = [self._dual_fold(train_ind, test_ind, kernel) for train_ind, test_ind in splits]
+        else:
+            gram, xy = self.X.T @ self.X, self.X.T @ self.y
+            self.folds = [self._primal_fold(train_ind, test_ind, gram, xy) for train_ind, test_ind in splits]
+
+    def _primal_fold(self, train_ind: np.array, test_ind: np.array, gram: np.array, xy: np.array) -> Fold:
+        x_test, y_test = self.X[test_ind], self.y[test_ind]
+        n_train = len(train_ind)
+        # the centered columns sum to zero, so the training sums are minus the test sums
+        x_mean = -x_test.sum(axis=0) / n_train
+        y_mean = -y_test.sum() / n_train
+        fold_gram = gram - x_test.T @ x_test - n_train * np.outer(x_mean, x_mean)
+        fold_xy = xy - x_test.T @ y_test - n_train * x_mean * y_mean
+        return Fold(train_ind, test_ind, x_mean, y_mean, fold_gram, fold_xy)
+
+    def _dual_fold(self, train_ind: np.array, test_ind: np.array, kernel: np.array) -> Fold:
+        x_mean = self.X[train_ind].mean(axis=0)
+        y_mean = self.y[train_ind].mean()
+        fold_kernel = kernel[np.ix_(train_ind, train_ind)]
+        row_mean = fold_kernel.mean(axis=0)
+        fold_kernel -= row_mean[:, None] + row_mean[None, :] - row_mean.mean()
+        return Fold(train_ind, test_ind, x_mean, y_mean, fold_kernel, self.y[train_ind] - y_mean)
+
+    def _to_coef(self, fold: Fold, solution: np.array) -> np.array:
+        """
+        Map a solution of the fold system (columns for several alphas) to feature coefficients.
+        """
+        if not self.dual:
+            return solution
+        # X_train centered by its mean, without materializing the centered copy
+        return self.X[fold.train_ind].T @ solution - np.multiply.outer(fold.x_mean, solution.sum(axis=0))
+
+    def coefs(self, alpha: float):
+        """
+        Solve the ridge problem of every fold.
+
+        Args:
+        - alpha (float): param for Ridge Regression
+
+        Return:
+        - np.array: coefficients, shape (n_splits, n_features)
+        - np.array: intercepts in the original coordinates, shape (n_splits,)
+        """
+        if alpha not in self._coefs:
+            coefs = []
+            for fold in self.folds:
+                system = fold.gram + alpha * np.eye(len(fold.gram))
+                coefs.append(self._to_coef(fold, linalg.solve(system, fold.rhs, assume_a="pos")))
+            coefs = np.stack(coefs)
+            self._coefs[alpha] = coefs, self.intercepts(coefs)
+        return self._coefs[alpha]
+
+    def coefs_path(self, alphas: list, folds: list = None):
+        """
+        Solve the ridge problem of every fold for all alphas, using one eigendecomposition per fold.
+
+        Args:
+        - alphas (list): params for Ridge Regression
+        - folds (list): Indices of the folds to solve, all if None
+
+        Return:
+        - np.array: coefficients, shape (n_folds, n_alphas, n_features)
+        - np.array: intercepts in the original coordinates, shape (n_folds, n_alphas)
+        """
+        alphas = np.asarray(alphas, dtype=np.float64)
+        folds = range(len(self.folds)) if folds is None else folds
+        coefs = []
+        for i in folds:
+            fold = self.folds[i]
+            eigvals, eigvecs = linalg.eigh(fold.gram)
+            projected = eigvecs.T @ fold.rhs
+            solutions = eigvecs @ (projected[:, None] / (eigvals[:, None] + alphas[None, :]))
+            coefs.append(self._to_coef(fold, solutions).T)
+        coefs = np.stack(coefs)
+        return coefs, self.intercepts(coefs, folds)
+
+    def intercepts(self, coefs: np.array, folds: list = None) -> np.array:
+        """
+        Intercepts in original coordinates for coefficients of shape (n_folds, ..., n_features).
+        """
+        folds = [self.folds[i] for i in folds] if folds is not None else self.folds
+        x_means = np.stack([fold.x_mean for fold in folds]) + self.x_offset
+        y_means = np.array([fold.y_mean for fold in folds]) + self.y_offset
+        x_means = x_means.reshape((len(folds),) + (1,) * (coefs.ndim - 2) + (self.n_features,))
+        y_means = y_means.reshape((len(folds),) + (1,) * (coefs.ndim - 2))
+        return y_means - np.sum(x_means * coefs, axis=-1)
+
+    def score(self, alpha: float) -> float:
+        """
+        Mean r^2 over the test parts of the folds.
+
+        Args:
+        - alpha (float): param for Ridge Regression
+
+        Return:
+        - r^2
+        """
+        coefs, intercepts = self.coefs(alpha)
+        r2 = []
+        for fold, coef, intercept in zip(self.folds, coefs, intercepts):
+            y_predict = (self.X[fold.test_ind] + self.x_offset) @ coef + intercept
+            r2.append(pearson_r2(self.y[fold.test_ind], y_predict))
+        return np.mean(r2)
+
+    def score_out(self, X_out: np.array, y_out: np.array, alpha: float) -> float:
+        """
+        Mean r^2 of the fold models evaluated on other data.
+
+        Args:
+        - X_out (np.array): Features for evaluation
+        - y_out (np.array): Consumption for evaluation
+        - alpha (float): param for Ridge Regression
+
+        Return:
+        - r^2
+        """
+        coefs, intercepts = self.coefs(alpha)
+        y_predict = np.asarray(X_out, dtype=np.float64) @ coefs.T + intercepts
+        return np.mean(pearson_r2(np.asarray(y_out, dtype=np.float64), y_predict))
+
+    def fold_scores_path(self, alphas: list, fold: int) -> np.array:
+        """
+        r^2 on the test part of one fold for all alphas.
+
+        Args:
+        - alphas (list): params for Ridge Regression
+        - fold (int): Fold index
+
+        Return:
+        - np.array: r^2, shape (n_alphas,)
+        """
+        coefs, intercepts = self.coefs_path(alphas, [fold])
+        test_ind = self.folds[fold].test_ind
+        y_predict = (self.X[test_ind] + self.x_offset) @ coefs[0].T + intercepts[0]
+        return pearson_r2(self.y[test_ind], y_predict)
+
+    def scores_path(self, alphas: list, n_jobs: int = 1) -> np.array:
+        """
+        r^2 of every fold for all alphas. The folds can be spread over a process pool, every worker receives the
+        engine once.
+
+        Args:
+        - alphas (list): params for Ridge Regression
+        - n_jobs (int): Number of processes, 1 runs in this process
+
+        Return:
+        - np.array: r^2, shape (n_splits, n_alphas)
+        """
+        folds = range(len(self.folds))
+        if n_jobs == 1:
+            return np.stack([self.fold_scores_path(alphas, fold) for fold in folds])
+
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(self,)) as pool:
+            return np.stack(list(pool.map(_worker_fold_scores_path, [(alphas, fold) for fold in folds])))
+
+    def model(self, alpha: float, fold: int = -1) -> Ridge:
+        """
+        Return the model of one fold (the last by default, as the KFold loops did) as fitted sklearn Ridge.
+
+        Args:
+        - alpha (float): param for Ridge Regression
+        - fold (int): Fold index
+
+        Return:
+        - Ridge
+        """
+        coefs, intercepts = self.coefs(alpha)
+        return as_ridge(coefs[fold], intercepts[fold], alpha)
+
+
+def as_ridge(coef: np.array, intercept: float, alpha: float) -> Ridge:
+    """
+    Wrap a closed-form solution into a sklearn Ridge, so predict() can be used as usual.
+    """
+    model = Ridge(alpha)
+    model.coef_ = coef
+    model.intercept_ = intercept
+    model.n_features_in_ = len(coef)
+    return model
+
+
+_worker_engine: KFoldRidge | None = None
+
+
+def _init_worker(engine: KFoldRidge) -> None:
+    global _worker_engine
+    _worker_engine = engine
+
+
+def _worker_fold_scores_path(args) -> np.array:
+    alphas, fold = args
+    return _worker_engine.fold_scores_path(alphas, fold)
@@ -1,46 +1,131 @@
 from __future__ import annotations
 
 from collections.abc import Mapping
+from dataclasses import dataclass
 from typing import Any, Optional
 
 import ee
+import numpy as np
 import pandas as pd
 import time
 from tqdm.auto import tqdm
 
+from lib.profiling import profiled, set_rows
+
+# approximate size of a point feature in a request without its properties, and the default size limit of a chunk
+# (Earth Engine rejects request payloads above 10 MB, the image graph also has to fit)
+FEATURE_OVERHEAD_BYTES = 250
+MAX_CHUNK_BYTES = 2_000_000
+
+
+@dataclass(frozen=True)
+class FcChunk:
+    '''Part of a DataFrame which is converted into one ee.FeatureCollection.
+
+    - index: position of the chunk
+    - rows: index labels of the rows in the chunk
+    - n_points: number of rows
+    - est_bytes: estimated size of the features in a request
+    '''
+    index: int
+    rows: list
+    n_points: int
+    est_bytes: int
+
+
 # taken from https://github.com/sustainlab-group/africa_poverty (slightly modified)
 
+@profiled()
 def df_to_fc(df: pd.DataFrame, lat_colname: str = 'lat',
              lon_colname: str = 'lon') -> ee.FeatureCollection:
     '''Create a ee.FeatureCollection from a pd.DataFrame.
 
     Args
-    - csv_path: str, path to CSV file that includes at least two columns for
-        latitude and longitude coordinates
+    - df: pd.DataFrame, includes at least two columns for latitude and
+        longitude coordinates
     - lat_colname: str, name of latitude column
     - lon_colname: str, name of longitude column
 
-    Returns: ee.FeatureCollection, contains one feature per row in the CSV file
+    Returns: ee.FeatureCollection, contains one feature per row in the DataFrame
     '''
-    # convert values to Python native types
+    # convert values to Python native types column by column
     # see https://stackoverflow.com/a/47424340
-    df = df.astype('object')
-
-    ee_features = []
-    for i in range(len(df)):
-        props = df.iloc[i].to_dict()
+    columns = [df[col].tolist() for col in df.columns]
+    names = list(df.columns)
 
-        # oddly EE wants (lon, lat) instead of (lat, lon)
-        _geometry = ee.Geometry.Point([
-            props[lon_colname],
-            props[lat_colname],
-        ])
-        ee_feat = ee.Feature(_geometry, props)
-        ee_features.append(ee_feat)
+    # oddly EE wants (lon, lat) instead of (lat, lon)
+    ee_features = [
+        ee.Feature(ee.Geometry.Point([lon, lat]), dict(zip(names, values)))
+        for lon, lat, values in zip(df[lon_colname].tolist(), df[lat_colname].tolist(), zip(*columns))
+    ]
 
+    set_rows(len(df))
     return ee.FeatureCollection(ee_features)
 
 
+def estimate_feature_bytes(df: pd.DataFrame) -> np.ndarray:
+    '''Estimate the size of every row as feature in a request: the
+    overhead of a point feature plus the names and printed values of the
+    properties.
+
+    Args
+    - df: pd.DataFrame
+
+    Returns: np.ndarray, estimated bytes per row
+    '''
+    sizes = np.full(len(df), FEATURE_OVERHEAD_BYTES, dtype=np.int64)
+    for col in df.columns:
+        # missing values are sent as null
+        sizes += len(str(col)) + 6 + df[col].astype(str).str.len().fillna(4).to_numpy(dtype=np.int64)
+    return sizes
+
+
+def plan_chunks(df: pd.DataFrame, max_points: Optional[int] = None,
+                max_bytes: Optional[int] = MAX_CHUNK_BYTES) -> list[FcChunk]:
+    '''Split the rows of a DataFrame into consecutive chunks with at most
+    max_points rows and at most max_bytes estimated request size each (a
+    single larger row still gets its own chunk).
+
+    Args
+    - df: pd.DataFrame
+    - max_points: None or int, maximal rows per chunk
+    - max_bytes: None or int, maximal estimated bytes per chunk
+
+    Returns: list of FcChunk
+    '''
+    sizes = estimate_feature_bytes(df)
+    ends = np.cumsum(sizes)
+    chunks = []
+    start = 0
+    while start < len(df):
+        end = len(df)
+        if max_points is not None:
+            end = min(end, start + max_points)
+        if max_bytes is not None:
+            offset = ends[start - 1] if start > 0 else 0
+            end = min(end, int(np.searchsorted(ends, offset + max_bytes, side='right')))
+        end = max(end, start + 1)
+        chunks.append(FcChunk(index=len(chunks), rows=df.index[start:end].tolist(),
+                              n_points=end - start, est_bytes=int(sizes[start:end].sum())))
+        start = end
+    return chunks
+
+
+def df_to_fc_chunks(df: pd.DataFrame, max_points: Optional[int] = None,
+                    max_bytes: Optional[int] = MAX_CHUNK_BYTES,
+                    lat_colname: str = 'lat', lon_colname: str = 'lon'
+                    ) -> list[tuple[ee.FeatureCollection, FcChunk]]:
+    '''Create one ee.FeatureCollection per chunk of plan_chunks, each small
+    enough to be sent with its own get_array_patches export.
+
+    Returns: list of (ee.FeatureCollection, FcChunk)
+    '''
+    chunks = plan_chunks(df, max_points, max_bytes)
+    starts = np.cumsum([0] + [chunk.n_points for chunk in chunks])
+    return [(df_to_fc(df.iloc[start:start + chunk.n_points], lat_colname, lon_colname), chunk)
+            for start, chunk in zip(starts, chunks)]
+
+
 def decode_qamask(img: ee.Image) -> ee.Image:
     '''
     Args
@@ -241,6 +326,7 @@ def get_array_patches(img: ee.Image,
                       dropselectors=dropselectors, bucket=bucket)
 
 
+@profiled()
 def wait_on_tasks(tasks: Mapping[Any, ee.batch.Task],
                   show_probar: bool = True,
                   poll_interval: int = 20,
@@ -278,6 +364,7 @@ def wait_on_tasks(tasks: Mapping[Any, ee.batch.Task],
         remaining_tasks = new_remaining_tasks
         time.sleep(poll_interval)
     progbar.close()
+    set_rows(len(tasks))
 
 
 class LandsatSR:
@@ -0,0 +1,272 @@
+"""
+Spatial index of the clusters, instead of identifying clusters by exact float lat/lon.
+
+- cluster_keys: stable integer keys from the coordinates rounded to a grid (1e-5 degrees, about 1 m), the same for
+  float32 and float64 copies of a coordinate (the CSVs and get_data) and independent of the order or the other
+  clusters of a dataset.
+- ClusterIndex: KD-tree on the 3D (earth-centered) coordinates of the clusters, so that distances are true distances
+  in meters. Nearest matches within a tolerance, clusters within r meters and clusters in a bounding box are
+  O(log n) queries (plus the number of results).
+- match_join: merge(on=["lat", "lon", "year"]) which falls back to the clusters within a tolerance for rows without an
+  exactly equal coordinate (float32/float64 copies or rounded coordinates).
+- buffer_bboxes and tile_order: the square buffers of the OSM extraction (2_osm.ipynb) and an order of the clusters
+  by spatial tile, so that chunks of requests cover compact areas.
+"""
+from __future__ import annotations
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from lib.local_patches import inverse_mercator, mercator
+
+EARTH_RADIUS_M = 6371008.8  # mean radius, for distances
+KEY_PRECISION = 1e-5  # degrees of the cluster key grid
+MATCH_TOLERANCE_M = 1.0  # float32 rounding moves a coordinate by less than 0.5 m
+OSM_BUFFER_M = 3360  # half side of the OSM boxes, in EPSG:3857 meters
+TILE_SIZE_M = 50_000  # EPSG:3857 meters
+
+
+def cluster_keys(lat, lon, precision: float = KEY_PRECISION) -> np.ndarray:
+    """
+    Stable integer key of every coordinate, the index of the closest point of a grid of `precision` degrees. The
+    coordinates are rounded to float32 first, so float32 and float64 copies of a coordinate get the same key.
+
+    Args:
+    - lat (np.array): Latitudes
+    - lon (np.array): Longitudes
+    - precision (float): Grid size in degrees
+
+    Return:
+    - np.array: int64 keys, equal for coordinates which round to the same grid point
+    """
+    lat = np.asarray(lat, dtype=np.float32).astype(np.float64)
+    lon = np.asarray(lon, dtype=np.float32).astype(np.float64)
+    lat_steps = np.rint((lat + 90) / precision).astype(np.int64)
+    lon_steps = np.rint((lon + 180) / precision).astype(np.int64)
+    return lat_steps * (int(round(360 / precision)) + 1) + lon_steps
+
+
+def key_coordinates(keys, precision: float = KEY_PRECISION):
+    """
+    Inverse of cluster_keys, returns the lat and lon of the grid points.
+    """
+    lat_steps, lon_steps = np.divmod(np.asarray(keys, dtype=np.int64), int(round(360 / precision)) + 1)
+    return lat_steps * precision - 90, lon_steps * precision - 180
+
+
+def to_xyz(lat, lon) -> np.ndarray:
+    """
+    Earth-centered coordinates in meters on a sphere, with shape (n, 3).
+    """
+    lat, lon = np.radians(np.asarray(lat, dtype=np.float64)), np.radians(np.asarray(lon, dtype=np.float64))
+    return EARTH_RADIUS_M * np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+def chord(distance_m: float) -> float:
+    """
+    Straight line distance of two points which are distance_m apart on the sphere.
+    """
+    return 2 * EARTH_RADIUS_M * np.sin(min(distance_m / (2 * EARTH_RADIUS_M), np.pi / 2))
+
+
+class ClusterIndex:
+
+    def __init__(self, lat, lon) -> None:
+        """
+        KD-tree of cluster coordinates. The results of the queries are positions into lat and lon.
+
+        Args:
+        - lat (np.array): Latitudes
+        - lon (np.array): Longitudes
+        """
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.tree = cKDTree(to_xyz(self.lat, self.lon))
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, lat_col: str = "lat", lon_col: str = "lon") -> ClusterIndex:
+        return cls(df[lat_col].to_numpy(), df[lon_col].to_numpy())
+
+    def __len__(self) -> int:
+        return len(self.lat)
+
+    def match(self, lat, lon, tolerance_m: float = MATCH_TOLERANCE_M) -> np.ndarray:
+        """
+        Nearest cluster of every point within the tolerance.
+
+        Args:
+        - lat (np.array): Latitudes of the points
+        - lon (np.array): Longitudes of the points
+        - tolerance_m (float): Maximal distance in meters
+
+        Return:
+        - np.array: position of the nearest cluster, -1 if there is none within the tolerance or the point is NaN
+        """
+        points = to_xyz(lat, lon).reshape(-1, 3)
+        positions = np.full(len(points), -1, dtype=np.int64)
+        valid = np.isfinite(points).all(axis=1)
+        if len(self) and valid.any():
+            _, found = self.tree.query(points[valid], distance_upper_bound=chord(tolerance_m))
+            positions[valid] = np.where(found == len(self), -1, found)
+        return positions.reshape(np.shape(lat))
+
+    def match_all(self, lat, lon, tolerance_m: float = MATCH_TOLERANCE_M) -> tuple:
+        """
+        All clusters of every point within the tolerance.
+
+        Args:
+        - lat (np.array): Latitudes of the points
+        - lon (np.array): Longitudes of the points
+        - tolerance_m (float): Maximal distance in meters
+
+        Return:
+        - np.array: positions of the points
+        - np.array: positions of their clusters, pairs ordered by point and then by cluster (NaN points have none)
+        """
+        points = to_xyz(lat, lon).reshape(-1, 3)
+        valid = np.flatnonzero(np.isfinite(points).all(axis=1))
+        if not len(self) or not len(valid):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        found = self.tree.query_ball_point(points[valid], chord(tolerance_m))
+        counts = np.fromiter((len(clusters) for clusters in found), dtype=np.int64, count=len(found))
+        point_positions = np.repeat(valid, counts)
+        cluster_positions = np.fromiter((c for clusters in found for c in sorted(clusters)), dtype=np.int64,
+                                        count=counts.sum())
+        return point_positions, cluster_positions
+
+    def within(self, lat: float, lon: float, radius_m: float) -> np.ndarray:
+        """
+        Return:
+        - np.array: sorted positions of the clusters within radius_m meters of the point
+        """
+        return np.sort(np.asarray(self.tree.query_ball_point(to_xyz(lat, lon), chord(radius_m)), dtype=np.int64))
+
+    def in_bbox(self, min_lon: float, min_lat: float, max_lon: float, max_lat: float) -> np.ndarray:
+        """
+        Clusters in a bounding box, from the clusters within the circle around the box.
+
+        Return:
+        - np.array: sorted positions of the clusters in the box (borders included)
+        """
+        center_lat, center_lon = (min_lat + max_lat) / 2, (min_lon + max_lon) / 2
+        center = to_xyz(center_lat, center_lon)
+        # along a parallel or a meridian of the box the distance to the center has no interior maximum, so the
+        # farthest point of the box is a corner
+        corners = to_xyz([min_lat, min_lat, max_lat, max_lat], [min_lon, max_lon, min_lon, max_lon])
+        radius = np.linalg.norm(corners - center, axis=1).max() * (1 + 1e-9) + 1e-6
+        candidates = np.sort(np.asarray(self.tree.query_ball_point(center, radius), dtype=np.int64))
+        lat, lon = self.lat[candidates], self.lon[candidates]
+        inside = (lat >= min_lat) & (lat <= max_lat) & (lon >= min_lon) & (lon <= max_lon)
+        return candidates[inside]
+
+
+def match_join(left: pd.DataFrame, right: pd.DataFrame, by: list | None = None, tolerance_m: float = MATCH_TOLERANCE_M,
+               lat_col: str = "lat", lon_col: str = "lon") -> pd.DataFrame:
+    """
+    Inner join of the rows of left and right with the same coordinates and by columns, like
+    left.merge(right, on=[lat, lon, *by]): every row of left is joined with all its matches in right (co-located
+    clusters give several rows), in the order of left and then of right. A row of left without an exactly equal
+    coordinate in right is joined with all rows of right within the tolerance instead, so float32/float64 or rounding
+    differences still match. Rows with an exact match never get the other rows within the tolerance, so the result
+    equals the merge whenever it matches a row.
+
+    Args:
+    - left (pd.Dataframe): Frame with lat_col and lon_col, its coordinates are kept
+    - right (pd.Dataframe): Frame with lat_col and lon_col
+    - by (list): Columns which have to be equal, e.g. ["year"]
+    - tolerance_m (float): Maximal distance in meters
+    - lat_col (str): Latitude column of both frames
+    - lon_col (str): Longitude column of both frames
+
+    Return:
+    - pd.Dataframe: columns of left and the other columns of right
+    """
+    by = list(by or [])
+    keys = [lat_col, lon_col] + by
+    left_lat, left_lon = left[lat_col].to_numpy(dtype=np.float64), left[lon_col].to_numpy(dtype=np.float64)
+    right_lat, right_lon = right[lat_col].to_numpy(dtype=np.float64), right[lon_col].to_numpy(dtype=np.float64)
+    if by:
+        right_groups = right.groupby(by, sort=False).indices
+        left_groups = left.groupby(by, sort=False).indices.items()
+    else:
+        right_groups = {(): np.arange(len(right))}
+        left_groups = [((), np.arange(len(left)))]
+
+    left_parts, right_parts = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    for group, rows in left_groups:
+        candidates = right_groups.get(group)
+        if candidates is None:
+            continue
+        index = ClusterIndex(right_lat[candidates], right_lon[candidates])
+        points, clusters = index.match_all(left_lat[rows], left_lon[rows], tolerance_m)
+        left_rows, right_rows = rows[points], candidates[clusters]
+        exact = (left_lat[left_rows] == right_lat[right_rows]) & (left_lon[left_rows] == right_lon[right_rows])
+        # rows of left with an exact match keep only the exact ones
+        has_exact = np.zeros(len(left), dtype=bool)
+        has_exact[left_rows[exact]] = True
+        keep = exact | ~has_exact[left_rows]
+        left_parts.append(left_rows[keep])
+        right_parts.append(right_rows[keep])
+
+    left_rows, right_rows = np.concatenate(left_parts), np.concatenate(right_parts)
+    order = np.lexsort((right_rows, left_rows))
+    result = left.iloc[left_rows[order]].reset_index(drop=True)
+    others = right.drop(columns=keys).iloc[right_rows[order]].reset_index(drop=True)
+    return pd.concat([result, others], axis=1)
+
+
+def buffer_bboxes(df: pd.DataFrame, half_side_m: float = OSM_BUFFER_M, tile_size_m: float | None = None,
+                  id_col: str = "id", lat_col: str = "lat", lon_col: str = "lon") -> dict:
+    """
+    Square buffers of the clusters as bounding boxes for OsmClient. The same boxes as buffering the points in
+    EPSG:3857 (buffer(half_side_m, cap_style=3)) and taking the bounds in EPSG:4326.
+
+    Args:
+    - df (pd.Dataframe): Clusters
+    - half_side_m (float): Half side of the squares in EPSG:3857 meters
+    - tile_size_m (float): Order the boxes by tile of this size (see tile_order), keep the order of df if None
+
+    Return:
+    - dict: id -> [minx, miny, maxx, maxy]
+    """
+    x, y = mercator(df[lat_col].to_numpy(dtype=np.float64), df[lon_col].to_numpy(dtype=np.float64))
+    min_lat, min_lon = inverse_mercator(x - half_side_m, y - half_side_m)
+    max_lat, max_lon = inverse_mercator(x + half_side_m, y + half_side_m)
+    order = np.arange(len(df)) if tile_size_m is None else tile_order(df[lat_col], df[lon_col], tile_size_m)
+    ids = df[id_col].to_numpy()
+    return {ids[i]: [float(min_lon[i]), float(min_lat[i]), float(max_lon[i]), float(max_lat[i])] for i in order}
+
+
+def tile_ids(lat, lon, tile_size_m: float = TILE_SIZE_M) -> np.ndarray:
+    """
+    Return:
+    - np.array: int64 id of the EPSG:3857 tile of every point
+    """
+    x, y = mercator(np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64))
+    cols = np.floor(x / tile_size_m).astype(np.int64)
+    rows = np.floor(y / tile_size_m).astype(np.int64)
+    # the tiles of a row are numbered west to east, 2**32 exceeds the tiles per row for any tile size above 1 cm
+    return rows * 2**32 + cols
+
+
+def tile_order(lat, lon, tile_size_m: float = TILE_SIZE_M) -> np.ndarray:
+    """
+    Return:
+    - np.array: positions of the points ordered by tile, the original order within a tile
+    """
+    return np.argsort(tile_ids(lat, lon, tile_size_m), kind="stable")
+
+
+def tile_batches(df: pd.DataFrame, tile_size_m: float = TILE_SIZE_M, lat_col: str = "lat",
+                 lon_col: str = "lon") -> list:
+    """
+    Split the rows into one batch per tile, e.g. to request OSM data or imagery per area.
+
+    Return:
+    - list: positions of the rows of every non-empty tile
+    """
+    tiles = tile_ids(df[lat_col], df[lon_col], tile_size_m)
+    order = np.argsort(tiles, kind="stable")
+    starts = np.flatnonzero(np.diff(tiles[order])) + 1
+    return [batch for batch in np.split(order, starts) if len(batch)]
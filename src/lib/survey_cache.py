@@ -0,0 +1,117 @@
+"""
+Columnar cache for the raw survey files (CSV and SPSS).
+
+Every raw file is parsed once and stored as Parquet in the cache directory. The cache file is keyed by the absolute
+path, modification time and size of the raw file, so a changed file is converted again and the stale entry removed.
+Reads from the cache only load the requested columns. Tables pyarrow can not store (object columns with mixed types)
+are cached as pickle, which is loaded completely.
+"""
+from __future__ import annotations
+
+import glob
+import hashlib
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "data", "lsms", "cache")
+
+
+def read_raw(path: str, columns: list = None) -> pd.DataFrame:
+    """
+    Read a raw survey file without the cache, CSV by extension otherwise SPSS.
+
+    Args:
+    - path (str): Raw file
+    - columns (list): Columns to read, all if None
+
+    Return:
+    - pd.Dataframe
+    """
+    if path.split(".")[-1].lower() == "csv":
+        return pd.read_csv(path, usecols=columns)
+    return pd.read_spss(path, usecols=columns)
+
+
+def cache_key(path: str) -> tuple:
+    """
+    Return:
+    - str: key of the file path
+    - str: key of the file version (modification time and size)
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    path_key = hashlib.sha1(path.encode()).hexdigest()[:12]
+    version_key = hashlib.sha1(f"{stat.st_mtime_ns}-{stat.st_size}".encode()).hexdigest()[:12]
+    return path_key, version_key
+
+
+def convert(path: str, cache_dir: str = DEFAULT_PATH) -> str:
+    """
+    Convert a raw file into the cache if it is not there yet.
+
+    Args:
+    - path (str): Raw file
+    - cache_dir (str): Cache directory
+
+    Return:
+    - str: path of the cache file
+    """
+    path_key, version_key = cache_key(path)
+    prefix = os.path.join(cache_dir, f"{os.path.basename(path)}-{path_key}-")
+    for ending in [".parquet", ".pkl"]:
+        if os.path.isfile(prefix + version_key + ending):
+            return prefix + version_key + ending
+
+    os.makedirs(cache_dir, exist_ok=True)
+    for stale in glob.glob(glob.escape(prefix) + "*"):
+        os.remove(stale)
+
+    df = read_raw(path)
+    df.attrs = {}  # read_spss stores the file metadata here, it is not needed and not serializable
+    target = prefix + version_key + ".parquet"
+    try:
+        df.to_parquet(target + ".tmp", index=False)
+    except (pa.ArrowException, TypeError, ValueError):
+        target = prefix + version_key + ".pkl"
+        df.to_pickle(target + ".tmp")
+    os.replace(target + ".tmp", target)
+    return target
+
+
+def read_cached(path: str, columns: list = None, cache_dir: str = DEFAULT_PATH) -> pd.DataFrame:
+    """
+    Read a raw survey file through the cache.
+
+    Args:
+    - path (str): Raw file
+    - columns (list): Columns to read, all if None
+    - cache_dir (str): Cache directory
+
+    Return:
+    - pd.Dataframe: same content as read_raw(path, columns)
+    """
+    cached = convert(path, cache_dir)
+    pickled = cached.endswith(".pkl")
+    df = pd.read_pickle(cached) if pickled else None
+    if columns is not None:
+        names = list(df.columns) if pickled else pq.read_schema(cached).names
+        missing = set(columns) - set(names)
+        if missing:
+            raise ValueError(f"Columns not found in {path}: {sorted(missing)}")
+        # keep the file order of the columns like usecols does
+        columns = [c for c in names if c in columns]
+    if pickled:
+        return df if columns is None else df[columns]
+    return pd.read_parquet(cached, columns=columns)
+
+
+def read_table(path: str, columns: list = None, cache_dir: str | None = DEFAULT_PATH) -> pd.DataFrame:
+    """
+    Read a raw survey file through the cache, or directly if cache_dir is None.
+    """
+    if cache_dir is None:
+        return read_raw(path, columns)
+    return read_cached(path, columns, cache_dir)
@@ -0,0 +1,166 @@
+"""
+Streaming conversion of the GZIP TFRecords into memory-mapped NumPy shards.
+
+The records are read one at a time with TfrecordHelper and written into fixed-shape .npy shards of
+(shard_size, 224, 224, bands). A Parquet index holds one row per image (shard, row, lat, lon, year, nightlight, file),
+so neither the conversion nor the reading needs more memory than a single shard.
+"""
+from __future__ import annotations
+
+import os
+
+from lib.tfrecordhelper import TfrecordHelper
+
+import numpy as np
+import pandas as pd
+
+INDEX_FILE = "index.parquet"
+SHARD_FILE = "shard_{:05d}.npy"
+IMAGE_SIZE = 224
+
+
+def is_broken(img: np.array, nl_index: int | None) -> bool:
+    """
+    Check if a record is broken: the nightlights are zero or one of the channels contains only zeros.
+
+    Args:
+    - img (np.array): Image (224, 224, bands)
+    - nl_index (int): Channel of the nightlights, None if not included
+
+    Return:
+    - bool
+    """
+    if nl_index is not None and np.mean(img[:, :, nl_index]) == 0:
+        return True
+    return not np.all(np.any(img, axis=(0, 1)))
+
+
+class ShardWriter:
+
+    def __init__(self, path: str, nbands: int, shard_size: int = 256, dtype=np.float16) -> None:
+        """
+        Writer which appends images to the shards of a directory.
+
+        Args:
+        - path (str): Output directory
+        - nbands (int): Number of bands of the images
+        - shard_size (int): Number of images per shard
+        - dtype: dtype of the stored images
+        """
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.nbands = nbands
+        self.shard_size = shard_size
+        self.dtype = dtype
+        self.shard = -1
+        self.row = shard_size
+        self.current = None
+        self.rows = []
+
+    def append(self, img: np.array, meta: dict) -> None:
+        """
+        Append an image and its metadata.
+        """
+        if self.row == self.shard_size:
+            self._next_shard()
+        self.current[self.row] = img
+        self.rows.append({"shard": self.shard, "row": self.row, **meta})
+        self.row += 1
+
+    def _next_shard(self) -> None:
+        if self.current is not None:
+            self.current.flush()
+        self.shard += 1
+        self.row = 0
+        self.current = np.lib.format.open_memmap(
+            os.path.join(self.path, SHARD_FILE.format(self.shard)), mode="w+", dtype=self.dtype,
+            shape=(self.shard_size, IMAGE_SIZE, IMAGE_SIZE, self.nbands))
+
+    def close(self) -> pd.DataFrame:
+        """
+        Truncate the last shard to its filled rows and write the index.
+
+        Return:
+        - pd.Dataframe: index
+        """
+        if self.current is not None:
+            self.current.flush()
+            if self.row < self.shard_size:
+                filled = np.array(self.current[:self.row])
+                del self.current
+                np.save(os.path.join(self.path, SHARD_FILE.format(self.shard)), filled)
+            self.current = None
+
+        index = pd.DataFrame(self.rows, columns=["shard", "row", "lat", "lon", "year", "nightlight", "file"])
+        index.to_parquet(os.path.join(self.path, INDEX_FILE), index=False)
+        return index
+
+
+def convert_tfrecords(paths: list, out_path: str, ls_bands: str = "ms", nl_band: str | None = "viirs",
+                      shard_size: int = 256, dtype=np.float16, drop_broken: bool = True) -> pd.DataFrame:
+    """
+    Convert TFRecord files into memory-mapped shards.
+
+    Args:
+    - paths (list): TFRecord files (GZIP)
+    - out_path (str): Output directory
+    - ls_bands (str): "ms" or "rgb", see TfrecordHelper
+    - nl_band (str): Include the nightlights band if not None, see TfrecordHelper
+    - shard_size (int): Number of images per shard
+    - dtype: dtype of the stored images (float16 halves the disk usage)
+    - drop_broken (bool): Skip records with zero nightlights or an empty channel
+
+    Return:
+    - pd.Dataframe: index of the written images
+    """
+    nbands = (3 if ls_bands == "rgb" else 7) + (nl_band is not None)
+    nl_index = nbands - 1 if nl_band is not None else None
+    writer = ShardWriter(out_path, nbands, shard_size, dtype)
+
+    for path in paths:
+        helper = TfrecordHelper(path, ls_bands=ls_bands, nl_band=nl_band)
+        helper.process_dataset()
+        for feature in helper.dataset:
+            img = feature["images"].numpy()
+            if drop_broken and is_broken(img, nl_index):
+                continue
+            lat, lon = feature["locs"].numpy()
+            writer.append(img, {
+                "lat": lat,
+                "lon": lon,
+                "year": int(feature["years"].numpy()),
+                "nightlight": np.mean(img[:, :, nl_index]) if nl_index is not None else np.nan,
+                "file": os.path.basename(path),
+            })
+
+    return writer.close()
+
+
+class ShardDataset:
+
+    def __init__(self, path: str) -> None:
+        """
+        Random access to converted shards with constant memory, the shards are memory-mapped on first access.
+        Can be wrapped by a torch Dataset.
+
+        Args:
+        - path (str): Directory written by convert_tfrecords
+        """
+        self.path = path
+        self.index = pd.read_parquet(os.path.join(path, INDEX_FILE))
+        self._shards = {}
+
+    def shard(self, shard: int) -> np.array:
+        """
+        Return the memory-mapped shard.
+        """
+        if shard not in self._shards:
+            self._shards[shard] = np.load(os.path.join(self.path, SHARD_FILE.format(shard)), mmap_mode="r")
+        return self._shards[shard]
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __getitem__(self, i: int) -> np.array:
+        shard, row = self.index.shard.iat[i], self.index.row.iat[i]
+        return self.shard(shard)[row]
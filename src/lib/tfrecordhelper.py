@@ -1,23 +1,99 @@
 from __future__ import annotations
 from collections.abc import Mapping
 
+from lib import profiling
+
+import json
 import tensorflow as tf
+import time
 import numpy as np
 
+
+class RunningStats():
+    def __init__(self, nchannels: int):
+        """
+        Per channel mean and variance, updated batch by batch (parallel Welford merge), so the data never has to be
+        in memory at once.
+
+        Args:
+        - nchannels (int): Number of channels
+        """
+        self.count = 0
+        self.mean = np.zeros(nchannels)
+        self.m2 = np.zeros(nchannels)
+
+    def update(self, batch: np.ndarray) -> None:
+        """
+        Merge a batch with the channels on the last axis.
+        """
+        x = batch.reshape(-1, batch.shape[-1]).astype(np.float64)
+        count = len(x)
+        if count == 0:
+            return
+        mean = x.mean(axis=0)
+        m2 = ((x - mean) ** 2).sum(axis=0)
+
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * count / total
+        self.m2 = self.m2 + m2 + delta**2 * self.count * count / total
+        self.count = total
+
+    def std(self) -> np.ndarray:
+        """
+        Population standard deviation (same as np.std).
+        """
+        return np.sqrt(self.m2 / self.count)
+
+
+def crop_bands(flat: tf.Tensor) -> tf.Tensor:
+    """
+    Turn stacked flat bands (..., bands, 255*255) into cropped images (..., 224, 224, bands). The bands are reshaped
+    and cropped together and transposed once, which is faster than cropping every band on its own.
+    """
+    shape = tf.concat([tf.shape(flat)[:-1], [255, 255]], axis=0)
+    img = tf.reshape(flat, shape)[..., 15:-16, 15:-16]
+    rank = len(flat.shape) + 1
+    return tf.transpose(img, list(range(rank - 3)) + [rank - 2, rank - 1, rank - 3])
+
+
+def measure_throughput(dataset: tf.data.Dataset, max_elements: int | None = None) -> float:
+    """
+    Iterate a dataset and return the number of records per second (batches are counted by their length).
+    """
+    count = 0
+    start = time.perf_counter()
+    for i, element in enumerate(dataset):
+        if max_elements is not None and i >= max_elements:
+            break
+        count += element_rows(element)
+    return count / (time.perf_counter() - start)
+
+
+def element_rows(element: dict) -> int:
+    """
+    Number of records of a dataset element, the length of a batch or 1.
+    """
+    years = element["years"]
+    return int(years.shape[0]) if len(years.shape) else 1
+
+
 class TfrecordHelper():
-    def __init__(self, path: str, ls_bands = "ms", nl_band = None):
+    def __init__(self, path: str | list, ls_bands = "ms", nl_band = None):
         """
         Init function for creating the TfrecordHelper object.
 
         Args:
-        - path (str): Path where tfrecord file is located.
+        - path (str | list): Path where tfrecord file is located, or a list of files.
         - ls_bands (str): Select landsat bands, "ms" (default) for all bands or "rgb" for RED, BLUE, GREEN bands.
         - nl_bands (str): For including the nightlight band, set any other value then None (default).
 
         """
 
-        self.raw_dataset: tf.TFRecordDataset = tf.data.TFRecordDataset(path, compression_type="GZIP")
+        self.paths: list = [path] if isinstance(path, str) else list(path)
+        self.raw_dataset: tf.TFRecordDataset = tf.data.TFRecordDataset(self.paths, compression_type="GZIP")
         self.dataset: tf.TFRecordDataset | None = None
+        self.pipeline: str | None = None  # name of the method which built self.dataset, used by iterate
         self.ls_bands: str = ls_bands
         self.nl_band: str | None = nl_band
         self.nbands = 8
@@ -28,15 +104,41 @@ class TfrecordHelper():
         self.scalar_keys = [self.keyword_lat, self.keyword_lon, self.keyword_year] # used 
         self.means = None
         self.stads = None
-    
+
+    def bands(self) -> list:
+        """
+        Return the selected bands in the order of the image channels.
+        """
+        bands = []
+        if self.ls_bands == "rgb":
+            # bands = ["BLUE", "GREEN", "RED"]  # BGR order
+            bands = ["RED", "GREEN", "BLUE"]
+        elif self.ls_bands == "ms":
+            bands = ["RED", "GREEN", "BLUE", "SWIR1", "SWIR2", "TEMP1", "NIR"]
+        if self.nl_band is not None:
+            bands += ["NIGHTLIGHTS"]
+        return bands
+
+    def feature_spec(self) -> dict:
+        """
+        Return the parsing spec of the selected bands and the scalar keys.
+        """
+        keys_to_features = {}
+        for band in self.bands():
+            keys_to_features[band] = tf.io.FixedLenFeature(shape=[255**2], dtype=tf.float32, default_value=tf.zeros([255**2], tf.float32))
+        for key in self.scalar_keys:
+            keys_to_features[key] = tf.io.FixedLenFeature(shape=[], dtype=tf.float32)
+        return keys_to_features
+
     def process_dataset(self, normalize = False):
         """
         Method for processing the raw_dataset based on selected bands.
         """
         
-        x = np.empty(shape=(255**2))
-        x.fill(0)
-        def_value = tf.convert_to_tensor(x, tf.float32)
+        bands = self.bands()
+        keys_to_features = self.feature_spec()
+        if normalize:
+            means, stads = self.norm_vectors(bands)
 
         def process_tfrecord(record: tf.train.Example) -> dict[any, any, any]:
             """
@@ -48,41 +150,149 @@ class TfrecordHelper():
             Returns: 
             result (dict[any, any, any]): contains processed feature
             """
-            bands = []
-            if self.ls_bands == "rgb":
-                # bands = ["BLUE", "GREEN", "RED"]  # BGR order
-                bands = ["RED", "GREEN", "BLUE"]
-            elif self.ls_bands == "ms":
-                bands = ["RED", "GREEN", "BLUE", "SWIR1", "SWIR2", "TEMP1", "NIR"]
-            if self.nl_band is not None:
-                bands += ["NIGHTLIGHTS"]
-
-            keys_to_features = {}
-            for band in bands:
-                keys_to_features[band] = tf.io.FixedLenFeature(shape=[255**2], dtype=tf.float32, default_value=def_value)
-            for key in self.scalar_keys:
-                keys_to_features[key] = tf.io.FixedLenFeature(shape=[], dtype=tf.float32)
-        
-            
-           
             # cons_pc = tf.cast(ex.get("cons_pc", -1), tf.float32)
 
             ex = tf.io.parse_single_example(record, features=keys_to_features)
             loc = tf.stack([ex[self.keyword_lat], ex[self.keyword_lon]])
             year = tf.cast(ex.get("year", -1), tf.int32)
-            for band in bands:
-                ex[band].set_shape([255 * 255])
-                # reshape to (255, 255) and crop to (224, 224)
-                ex[band] = tf.reshape(ex[band], [255, 255])[15:-16, 15:-16]
-                if normalize:
-                    if band == "NIGHTLIGHTS":
-                        ex[band] = (ex[band] - self.means["VIIRS"]) / self.stads["VIIRS"]
-                    else:
-                        ex[band] = (ex[band] - self.means[band]) / self.stads[band]
-
-            img = tf.stack([ex[band] for band in bands], axis=2)
+            img = crop_bands(tf.stack([ex[band] for band in bands]))
+            if normalize:
+                img = (img - means) / stads
             result = {"images": img, "locs": loc, "years": year}
             return result
         
         self.dataset = self.raw_dataset.map(process_tfrecord, num_parallel_calls=3)
-    
\ No newline at end of file
+        self.pipeline = "process_dataset"
+    
+    def records(self, interleave: bool = True, cycle_length: int | None = None, deterministic: bool = True) -> tf.data.Dataset:
+        """
+        Dataset of the serialized records, the files are interleaved if there are several.
+        """
+        if interleave and len(self.paths) > 1:
+            return tf.data.Dataset.from_tensor_slices(self.paths).interleave(
+                lambda path: tf.data.TFRecordDataset(path, compression_type="GZIP"),
+                cycle_length=cycle_length or tf.data.AUTOTUNE, num_parallel_calls=tf.data.AUTOTUNE,
+                deterministic=deterministic)
+        return self.raw_dataset
+
+    def norm_vectors(self, bands: list):
+        """
+        Return means and stads of the bands as vectors, broadcastable over the channel axis.
+        """
+        means = tf.constant([self.means[self.stats_key(band)] for band in bands], tf.float32)
+        stads = tf.constant([self.stads[self.stats_key(band)] for band in bands], tf.float32)
+        return means, stads
+
+    def process_nightlights(self, batch_size: int = 32, interleave: bool = True):
+        """
+        Method for processing only the nightlights summary of the records: the mean of the cropped NIGHTLIGHTS band,
+        without decoding the landsat bands. The elements are batches of {"nightlights", "locs", "years"}.
+
+        Args:
+        - batch_size (int): Number of records per batch
+        - interleave (bool): Read the files in parallel instead of one after the other
+        """
+        keys_to_features = {key: value for key, value in self.feature_spec().items() if key not in self.bands()}
+        keys_to_features["NIGHTLIGHTS"] = tf.io.FixedLenFeature(shape=[255**2], dtype=tf.float32, default_value=tf.zeros([255**2], tf.float32))
+
+        def process_batch(records: tf.Tensor) -> dict[any, any, any]:
+            ex = tf.io.parse_example(records, features=keys_to_features)
+            loc = tf.stack([ex[self.keyword_lat], ex[self.keyword_lon]], axis=1)
+            year = tf.cast(ex[self.keyword_year], tf.int32)
+            nightlights = tf.reduce_mean(tf.reshape(ex["NIGHTLIGHTS"], [-1, 255, 255])[:, 15:-16, 15:-16], axis=[1, 2])
+            return {"nightlights": nightlights, "locs": loc, "years": year}
+
+        self.dataset = (self.records(interleave).batch(batch_size)
+                        .map(process_batch, num_parallel_calls=tf.data.AUTOTUNE)
+                        .prefetch(tf.data.AUTOTUNE))
+        self.pipeline = "process_nightlights"
+
+    def process_dataset_batched(self, batch_size: int = 32, normalize = False, interleave: bool = True,
+                                cycle_length: int | None = None, cache: str | None = None, prefetch: bool = True,
+                                deterministic: bool = True):
+        """
+        Method for processing the raw_dataset in batches: the serialized records are batched first and every batch is
+        parsed by one parse_example call. All stages use AUTOTUNE parallelism. The elements of the dataset are the
+        same as in process_dataset with a leading batch dimension.
+
+        Args:
+        - batch_size (int): Number of records per batch
+        - normalize (bool): Normalize the bands with means and stads
+        - interleave (bool): Read the files in parallel instead of one after the other
+        - cycle_length (int): Number of files read at the same time, AUTOTUNE if None
+        - cache (str): Cache the parsed batches, "" in memory, otherwise in the given file
+        - prefetch (bool): Prefetch batches while the consumer is busy
+        - deterministic (bool): Keep the record order, can be disabled for more throughput
+        """
+        autotune = tf.data.AUTOTUNE
+        bands = self.bands()
+        keys_to_features = self.feature_spec()
+        if normalize:
+            means, stads = self.norm_vectors(bands)
+
+        def process_batch(records: tf.Tensor) -> dict[any, any, any]:
+            ex = tf.io.parse_example(records, features=keys_to_features)
+            loc = tf.stack([ex[self.keyword_lat], ex[self.keyword_lon]], axis=1)
+            year = tf.cast(ex[self.keyword_year], tf.int32)
+            img = crop_bands(tf.stack([ex[band] for band in bands], axis=1))
+            if normalize:
+                img = (img - means) / stads
+            return {"images": img, "locs": loc, "years": year}
+
+        dataset = self.records(interleave, cycle_length, deterministic).batch(batch_size).map(process_batch, num_parallel_calls=autotune, deterministic=deterministic)
+        if cache is not None:
+            dataset = dataset.cache(cache)
+        if prefetch:
+            dataset = dataset.prefetch(autotune)
+        self.dataset = dataset
+        self.pipeline = "process_dataset_batched"
+
+    def iterate(self):
+        """
+        Iterate self.dataset. With profiling enabled (see profiling.py) the iteration is recorded as the span
+        TfrecordHelper.{pipeline} with the number of records.
+        """
+        return profiling.iterate(self.dataset, f"TfrecordHelper.{self.pipeline}", rows=element_rows)
+
+    def stats_key(self, band: str) -> str:
+        """
+        Key of a band in means and stads, the nightlights are stored as VIIRS.
+        """
+        return "VIIRS" if band == "NIGHTLIGHTS" else band
+
+    def compute_stats(self, batch_size: int = 32):
+        """
+        Compute the mean and standard deviation of every selected band in one streaming pass over the raw dataset and
+        set them as means and stads. Only one batch is in memory at a time. Replaces self.dataset.
+
+        Args:
+        - batch_size (int): Number of records per batch
+
+        Return:
+        - means (dict), stads (dict)
+        """
+        bands = self.bands()
+        stats = RunningStats(len(bands))
+        self.process_dataset_batched(batch_size=batch_size)
+        for batch in self.iterate():
+            stats.update(batch["images"].numpy())
+
+        self.means = {self.stats_key(band): float(value) for band, value in zip(bands, stats.mean)}
+        self.stads = {self.stats_key(band): float(value) for band, value in zip(bands, stats.std())}
+        return self.means, self.stads
+
+    def save_stats(self, path: str) -> None:
+        """
+        Write means and stads into a json file.
+        """
+        with open(path, "w") as f:
+            json.dump({"means": self.means, "stads": self.stads}, f, indent=4)
+
+    def load_stats(self, path: str) -> None:
+        """
+        Load means and stads from a json file written by save_stats, used by process_dataset(normalize=True).
+        """
+        with open(path) as f:
+            stats = json.load(f)
+        self.means = stats["means"]
+        self.stads = stats["stads"]
@@ -0,0 +1,136 @@
+"""
+Pre-joined training table: the result of get_data (LSMS x CNN x OSM) materialized once.
+
+The table is a feature store (see feature_store.py) whose index holds the LSMS and OSM columns and whose float32
+matrix holds the CNN features, plus table.json with the OSM column names and the row range of every (country, year)
+survey. Every row carries the integer cluster key of its coordinates (see spatial_index.py). Loading memory-maps the
+matrix and reads only the rows of the requested surveys, without any join.
+
+table.json also stores a fingerprint of the inputs (path, size and modification time of every file), get_data rebuilds
+the table when an input changed, e.g. a new partition or a rewritten feature store.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+
+from lib.feature_store import CNN_PREFIX, cnn_columns, load_feature_store, write_feature_store
+from lib.spatial_index import cluster_keys
+
+import numpy as np
+import pandas as pd
+
+TABLE_FILE = "table.json"
+TABLE_VERSION = 2  # tables of another version are rebuilt (2: cluster keys from the coordinates)
+
+
+def is_training_table(path: str) -> bool:
+    """
+    Check if path is a training table.
+    """
+    return os.path.isfile(os.path.join(path, TABLE_FILE))
+
+
+def input_fingerprint(paths: list) -> str:
+    """
+    Fingerprint of input files and directories (all files below them), from their paths, sizes and modification
+    times. Missing paths are part of the fingerprint too, so creating them changes it.
+
+    Args:
+    - paths (list): Files or directories
+
+    Return:
+    - str: hex digest
+    """
+    digest = hashlib.sha1()
+    for path in paths:
+        path = os.path.abspath(path)
+        if os.path.isdir(path):
+            files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+        else:
+            files = [path]
+        for file in files:
+            if os.path.isfile(file):
+                stat = os.stat(file)
+                digest.update(f"{file}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+            else:
+                digest.update(f"{file}\0missing\n".encode())
+    return digest.hexdigest()
+
+
+def table_fingerprint(path: str) -> str | None:
+    """
+    Return:
+    - str: fingerprint of the inputs the table was built from, None if the table has none or another TABLE_VERSION
+    """
+    with open(os.path.join(path, TABLE_FILE), "r") as f:
+        table = json.load(f)
+    return table.get("inputs") if table.get("version") == TABLE_VERSION else None
+
+
+def write_training_table(path: str, complete: pd.DataFrame, all_cols: list, fingerprint: str | None = None) -> None:
+    """
+    Materialize the output of get_data. The rows of a survey are stored contiguously, in their original order.
+
+    Args:
+    - path (str): Directory of the table
+    - complete (pd.Dataframe): Merged data, with either the "features" column or the cnn_* columns
+    - all_cols (list): OSM feature columns
+    - fingerprint (str): input_fingerprint of the inputs of complete
+    """
+    codes, surveys = pd.factorize(pd.MultiIndex.from_arrays([complete["country"], complete["year"].astype(int)]))
+    order = np.argsort(codes, kind="stable")
+    complete = complete.iloc[order].reset_index(drop=True)
+
+    if "features" in complete.columns:
+        features = np.array(complete["features"].to_list(), dtype=np.float32)
+        index = complete.drop(columns=["features"])
+    else:
+        cnn_cols = [col for col in complete.columns if col.startswith(CNN_PREFIX)]
+        features = complete[cnn_cols].to_numpy(dtype=np.float32)
+        index = complete.drop(columns=cnn_cols)
+    # integer cluster key of the coordinates (spatial_index.cluster_keys), the same in every subset and rebuild
+    cluster = pd.DataFrame({"cluster": cluster_keys(index["lat"], index["lon"])})
+    index = pd.concat([index, cluster], axis=1)
+    write_feature_store(path, features, index)
+
+    starts = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(surveys)))])
+    table = {
+        "version": TABLE_VERSION,
+        "inputs": fingerprint,
+        "all_cols": list(all_cols),
+        "surveys": [{"country": country, "year": int(year), "start": int(starts[i]), "end": int(starts[i + 1])}
+                    for i, (country, year) in enumerate(surveys)],
+    }
+    with open(os.path.join(path, TABLE_FILE), "w") as f:
+        json.dump(table, f, indent=4)
+
+
+def load_training_table(path: str, countries: list = None, years: list = None):
+    """
+    Load the training table with the contract of get_data.
+
+    Args:
+    - path (str): Directory of the table
+    - countries (list): Only load these countries, all if None
+    - years (list): Only load these survey years, all if None
+
+    Return:
+    - pd.Dataframe: merged data, the CNN features as cnn_* columns
+    - list: features of OSM
+    """
+    with open(os.path.join(path, TABLE_FILE), "r") as f:
+        table = json.load(f)
+    index, features = load_feature_store(path)
+
+    years = None if years is None else [int(year) for year in years]
+    ranges = [(survey["start"], survey["end"]) for survey in table["surveys"]
+              if (countries is None or survey["country"] in countries) and (years is None or survey["year"] in years)]
+    if len(ranges) != len(table["surveys"]):
+        rows = np.concatenate([np.arange(start, end) for start, end in ranges] or [np.zeros(0, dtype=int)])
+        index = index.iloc[rows].reset_index(drop=True)
+        features = features[rows]
+
+    frame = pd.DataFrame(features, columns=cnn_columns(features.shape[1]), copy=False)
+    return pd.concat([index, frame], axis=1), table["all_cols"]
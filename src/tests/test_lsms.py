@@ -0,0 +1,135 @@
+"""
+Equivalence of the vectorized LSMS.process_survey with the row based implementation it replaced, on synthetic tables
+shaped like every survey of country_keys.json (its keys, rural codes and tags).
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from lib.lsms import LSMS
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "data", "lsms", "country_keys.json")
+with open(CONFIG_PATH, "r") as f:
+    CONFIG = json.load(f)
+SURVEYS = [(country, year) for country in CONFIG for year in CONFIG[country]]
+
+# raw values of the rural column, the way the files are read (pd.read_spss gives categoricals, pd.read_csv ints or
+# strings)
+RURAL_VALUES = {
+    ("ETH", "2013"): pd.Categorical(["Rural", "Small town", "Large town", "Urban"]),
+    ("ETH", "2015"): [1, 2, 3],
+    ("ETH", "2018"): ["1. RURAL", "2. URBAN"],
+    ("MW", "2016"): [1, 2],
+    ("MW", "2019"): [1, 2],
+    ("NG", "2012"): [0, 1],
+    ("NG", "2015"): [0, 1],
+    ("NG", "2018"): ["1. Urban", "2. Rural"],
+    ("TZA", "2012"): [1, 2],
+    ("TZA", "2014"): [1, 2],
+}
+
+
+def baseline_process_survey(lsms: LSMS, cons_key: str, hhsize_key: str, lat_key: str, lon_key: str,
+                            hhid_key: str = "hhid", rural_key: str = "rural", rural_tag: str = "", urban_tag: str = "",
+                            multiply: bool = True) -> pd.DataFrame:
+    """
+    LSMS.process_survey before the vectorization. Two changes let it run on pandas 3 without changing the result: the
+    cluster sums only cover the numeric columns (the old sum also concatenated the household ids, which were dropped)
+    and the rural column is object before the tags are written into it.
+    """
+    df_cons: pd.DataFrame = lsms.df_cons.copy()
+    if multiply:
+        df_cons["_cons_ph_"] = df_cons[cons_key] * df_cons[hhsize_key]
+    else:
+        df_cons["_cons_ph_"] = df_cons[cons_key]
+
+    df_cons["_pph_"] = lsms.df_cons[hhsize_key]
+    df_cons["_cons_ph_"] = df_cons["_cons_ph_"] / lsms.ppp / 365
+    df_cons = df_cons[[hhid_key, "_cons_ph_", "_pph_", rural_key]]
+
+    df_cords: pd.DataFrame = lsms.df_hh[[hhid_key, lat_key, lon_key]]
+    df_cords = df_cords.rename(columns={lat_key: 'lat', lon_key: 'lon'})
+
+    tmp_processed: pd.DataFrame = pd.merge(df_cons, df_cords, on=hhid_key)
+    tmp_processed.dropna(inplace=True)
+
+    rural = tmp_processed[["lat", "lon", rural_key]].drop_duplicates().dropna()
+    rural[rural_key] = pd.Series(rural[rural_key].to_list(), index=rural.index, dtype=object)
+
+    if urban_tag == "":
+        urban_tag = "urban"
+    for tag in urban_tag.split(","):
+        rural.loc[rural[rural_key].astype(str).str.contains(tag, case=False), rural_key] = "urban"
+
+    if rural_tag == "":
+        rural_tag = "rural"
+    for tag in rural_tag.split(","):
+        rural.loc[rural[rural_key].astype(str).str.contains(tag, case=False), rural_key] = "rural"
+
+    processed = tmp_processed.groupby(["lat", "lon"])[["_cons_ph_", "_pph_"]].sum().reset_index()
+    processed["_cons_pc_"] = processed["_cons_ph_"] / processed["_pph_"]
+    processed["country"] = lsms.country_iso
+    processed["year"] = lsms.year
+    processed = processed[["country", "year", "lat", "lon", "_cons_pc_"]]
+    processed["id"] = [f"{lsms.country_iso}_{lsms.year}_{i}" for i in range(len(processed))]
+    processed = processed.merge(rural, on=["lat", "lon"])
+    processed = processed.rename(columns={"_cons_pc_": "cons_pc", rural_key: "rural"})
+    rural_values = processed["rural"].infer_objects()
+    return processed.assign(rural=rural_values)
+
+
+def survey_tables(entry: dict, rural_values, n_households: int = 400, n_clusters: int = 40, seed: int = 0) -> tuple:
+    """
+    Consumption and geovariable tables with the keys of a config entry. Clusters share their coordinates, some
+    households lack coordinates, consumption or a geovariable row, and a few clusters mix rural codes.
+    """
+    rng = np.random.default_rng(seed)
+    hhid = pd.Series([f"{1000 + i:06d}" for i in range(n_households)])
+    cluster = rng.integers(0, n_clusters, n_households)
+    cluster_lat = rng.uniform(-15, 15, n_clusters).round(6)
+    cluster_lon = rng.uniform(25, 45, n_clusters).round(6)
+    cluster_rural = rng.integers(0, len(rural_values), n_clusters)
+    household_rural = np.where(rng.random(n_households) < 0.05, rng.integers(0, len(rural_values), n_households),
+                               cluster_rural[cluster])
+    if isinstance(rural_values, pd.Categorical):
+        rural = pd.Categorical.from_codes(household_rural, categories=rural_values.categories)
+    else:
+        rural = np.asarray(rural_values, dtype=object)[household_rural]
+        rural = pd.Series(rural).infer_objects()
+
+    cons = pd.Series(rng.lognormal(10, 1, n_households))
+    cons[rng.random(n_households) < 0.02] = np.nan
+    df_cons = pd.DataFrame({entry["hhid_key"]: hhid, entry["cons_key"]: cons,
+                            entry["hhsize_key"]: rng.integers(1, 12, n_households), entry["rural_key"]: rural})
+    df_cons = df_cons.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+    lat = pd.Series(cluster_lat[cluster])
+    lat[rng.random(n_households) < 0.02] = np.nan
+    df_hh = pd.DataFrame({entry["hhid_key"]: hhid, entry["lat_key"]: lat, entry["lon_key"]: cluster_lon[cluster]})
+    df_hh = df_hh.iloc[rng.permutation(n_households)[:n_households - 10]].reset_index(drop=True)
+    return df_cons, df_hh
+
+
+@pytest.mark.parametrize("country,year", SURVEYS)
+def test_process_survey_matches_baseline(country, year):
+    entry = CONFIG[country][year]
+    df_cons, df_hh = survey_tables(entry, RURAL_VALUES[(country, year)])
+    keys = dict(cons_key=entry["cons_key"], hhsize_key=entry["hhsize_key"], lat_key=entry["lat_key"],
+                lon_key=entry["lon_key"], hhid_key=entry["hhid_key"], rural_key=entry["rural_key"],
+                rural_tag=entry["rural"], urban_tag=entry["urban"], multiply=entry["multiply"])
+
+    lsms = LSMS(country, year, ppp=1.0)
+    lsms.df_cons, lsms.df_hh = df_cons, df_hh
+    expected = baseline_process_survey(lsms, **keys)
+    lsms.process_survey(**keys)
+
+    # the fixture has clusters with several rural values, which get one row each
+    assert expected.duplicated(["lat", "lon"]).any()
+    pd.testing.assert_frame_equal(lsms.processed, expected)
+
+
+def test_survey_values_cover_config():
+    assert set(RURAL_VALUES) == set(SURVEYS)
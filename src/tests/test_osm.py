@@ -0,0 +1,76 @@
+"""
+Conversion of ohsome responses into the feature tables.
+
+ohsome-py (0.1.0) returns the responses sorted by (boundary, tag, timestamp), so "remainder" comes after the tags of a
+boundary, while the API itself lists it first. The tables must not depend on that order.
+"""
+import numpy as np
+import pandas as pd
+
+from lib.osm import LENGTH_METRICS, POI_TYPES, ROAD_TYPES, pois_frame, road_frame, tag_matrix
+
+TIMESTAMP = "2015-12-31T00:00:00Z"
+
+
+def ohsome_frame(rows: list, grouped: bool = True) -> pd.DataFrame:
+    """
+    Response frame of OsmClient / ohsome-py from (boundary, [tag,] value) rows, sorted like ohsome-py.
+    """
+    names = ["boundary", "tag"] if grouped else ["boundary"]
+    frame = pd.DataFrame(rows, columns=names + ["value"])
+    frame["timestamp"] = pd.to_datetime(TIMESTAMP)
+    return frame.set_index(names + ["timestamp"]).sort_index()
+
+
+POI_ROWS = [
+    ("ETH_2015_0", "amenity=hostel", 1.0), ("ETH_2015_0", "amenity=car rental", 2.0), ("ETH_2015_0", "remainder", 7.0),
+    ("ETH_2015_1", "amenity=car rental", 6.0), ("ETH_2015_1", "amenity=Shelter", 3.0), ("ETH_2015_1", "remainder", 4.0),
+    ("ETH_2015_2", "amenity=furniture_shop", 5.0), ("ETH_2015_2", "remainder", 5.0),
+]
+
+
+def test_sorted_response_puts_remainder_last():
+    tags = ohsome_frame(POI_ROWS).index.get_level_values("tag")
+    assert list(tags[:3]) == ["amenity=car rental", "amenity=hostel", "remainder"]
+
+
+def test_tag_matrix_keeps_values_of_their_boundary():
+    matrix = tag_matrix(ohsome_frame(POI_ROWS), "amenity", ["hostel", "car_rental", "shelter", "furniture_shop"])
+    expected = pd.DataFrame({"hostel": [1.0, 0.0, 0.0], "car_rental": [2.0, 6.0, 0.0], "shelter": [0.0, 3.0, 0.0],
+                             "furniture_shop": [0.0, 0.0, 5.0]}, index=["ETH_2015_0", "ETH_2015_1", "ETH_2015_2"])
+    pd.testing.assert_frame_equal(matrix, expected, check_names=False)
+
+
+def test_tag_matrix_does_not_depend_on_row_order():
+    frame = ohsome_frame(POI_ROWS)
+    api_order = frame.iloc[np.argsort(frame.index.get_level_values("tag") != "remainder", kind="stable")]
+    api_order = api_order.iloc[np.argsort(api_order.index.get_level_values("boundary"), kind="stable")]
+    pd.testing.assert_frame_equal(tag_matrix(api_order, "amenity", POI_TYPES), tag_matrix(frame, "amenity", POI_TYPES))
+
+
+def test_pois_frame_columns():
+    frame = pois_frame(ohsome_frame(POI_ROWS))
+    assert list(frame.columns) == POI_TYPES + ["id"]
+    assert frame.id.tolist() == ["ETH_2015_0", "ETH_2015_1", "ETH_2015_2"]
+    # tags which never occur stay int columns, as in _all_pois.csv
+    assert frame["library"].dtype == np.int64
+
+
+def test_road_frame_on_sorted_responses():
+    boundaries = ["MW_2016_0", "MW_2016_1"]
+    responses = {}
+    for i, metric in enumerate(LENGTH_METRICS):
+        responses[f"total_{metric}"] = ohsome_frame([(b, 10.0 * (i + 1) + j) for j, b in enumerate(boundaries)],
+                                                    grouped=False)
+        responses[metric] = ohsome_frame([
+            ("MW_2016_0", "highway=track", 1.0 + i), ("MW_2016_0", "remainder", 9.0),
+            ("MW_2016_1", "highway=primary", 2.0 + i), ("MW_2016_1", "highway=track", 3.0 + i),
+            ("MW_2016_1", "remainder", 9.0),
+        ])
+    frame = road_frame(responses).set_index("id")
+    assert frame.index.tolist() == boundaries
+    assert frame["total_length"].tolist() == [20.0, 21.0]
+    assert frame["count_track"].tolist() == [1.0, 3.0]
+    assert frame["length_primary"].tolist() == [0.0, 3.0]
+    assert (frame["density_trunk"] == 0).all()
+    assert [col for col in frame.columns if col.startswith("count_")] == [f"count_{name}" for name in ROAD_TYPES]
@@ -0,0 +1,53 @@
+"""
+match_join against the exact merge of get_data, and the cluster keys of the training table.
+"""
+import numpy as np
+import pandas as pd
+
+from lib.spatial_index import cluster_keys, match_join
+
+
+def clusters() -> pd.DataFrame:
+    # clusters 0 and 1 are co-located, cluster 3 is 0.5 m north of cluster 2
+    return pd.DataFrame({
+        "id": ["ETH_2015_0", "ETH_2015_1", "ETH_2015_2", "ETH_2015_3", "MW_2016_0"],
+        "year": [2015, 2015, 2015, 2015, 2016],
+        "lat": [9.1, 9.1, 7.25, 7.25 + 0.5 / 111_195, -13.5],
+        "lon": [38.7, 38.7, 36.8, 36.8, 33.8],
+    })
+
+
+def cnn(lsms: pd.DataFrame) -> pd.DataFrame:
+    return lsms[["lat", "lon", "year"]].assign(row=np.arange(len(lsms)))
+
+
+def test_match_join_equals_merge_with_co_located_clusters():
+    lsms = clusters()
+    expected = lsms.merge(cnn(lsms), on=["lat", "lon", "year"])
+    result = match_join(lsms, cnn(lsms), by=["year"])
+    # every co-located cluster is joined with both CNN rows, like the merge
+    assert len(result) == 7
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_match_join_falls_back_to_tolerance_without_exact_match():
+    lsms = clusters()
+    features = cnn(lsms).astype({"lat": np.float32, "lon": np.float32})
+    result = match_join(lsms, features, by=["year"])
+    assert lsms.merge(features, on=["lat", "lon", "year"]).empty
+    # clusters 2 and 3 are within 1 m of each other, both get both rows
+    assert result.groupby("id").row.apply(list).to_dict() == {
+        "ETH_2015_0": [0, 1], "ETH_2015_1": [0, 1], "ETH_2015_2": [2, 3], "ETH_2015_3": [2, 3], "MW_2016_0": [4]}
+
+
+def test_match_join_requires_equal_by_columns():
+    lsms = clusters()
+    assert match_join(lsms, cnn(lsms).assign(year=2019), by=["year"]).empty
+
+
+def test_cluster_keys_do_not_depend_on_subset_or_precision():
+    lsms = clusters()
+    keys = cluster_keys(lsms.lat, lsms.lon)
+    assert keys.dtype == np.int64
+    np.testing.assert_array_equal(cluster_keys(lsms.lat[2:], lsms.lon[2:]), keys[2:])
+    np.testing.assert_array_equal(cluster_keys(lsms.lat.astype(np.float32), lsms.lon.astype(np.float32)), keys)